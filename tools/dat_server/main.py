@@ -0,0 +1,244 @@
+"""
+Serves the game's dat files over HTTP on localhost so single files can be
+opened in a browser (or curl, a hex editor that can open URLs, etc.) without
+dumping anything first.
+
+/<name>            the decompressed file (ex: /dd2d262c3b39fbd1)
+/<name>/           the files inside of an RPS
+/<name>/<member>   a single file inside of an RPS
+"""
+
+import argparse
+import html
+import os
+import re
+import sys
+import threading
+from collections import OrderedDict
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote, unquote, urlsplit
+sys.path.append("../../")  # hack to use tools
+from tools.idx_searcher.main import CATALOG_DB, get_catalog, get_idx_files
+from tools.lib.catalog import IdxCatalog
+from tools.lib.datfile import DatEntry
+from tools.lib.extensions import HEADER_SIZE, get_extension
+from tools.lib.rpsfile import RpsFile
+
+# content types for the extensions a browser can do something with.
+# everything else is served as application/octet-stream.
+CONTENT_TYPES = {
+    ".xml": "application/xml",
+    ".dds": "image/vnd-ms.dds",
+    ".fileset": "text/plain; charset=utf-8",
+    ".group": "text/plain; charset=utf-8",
+}
+
+# parsed RPS files kept around so browsing inside one doesn't re-read it every request
+RPS_CACHE_SIZE = 8
+
+RANGE_PATTERN = re.compile(r"bytes=(\d*)-(\d*)$")
+
+
+def parse_range(header: str, size: int):
+    """
+    Parses a Range header into an inclusive (start, end) tuple.
+    Returns None if there's no header or it's one we don't handle (ex: multiple ranges),
+    in which case the whole file is sent. Raises ValueError if the range can't be satisfied.
+    """
+    if not header:
+        return None
+    match = RANGE_PATTERN.match(header.strip())
+    if not match:
+        return None
+
+    start, end = match.groups()
+    if not start and not end:
+        return None
+    if not start:  # last n bytes
+        length = int(end)
+        if length == 0:
+            raise ValueError(header)
+        return max(size - length, 0), size - 1
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        raise ValueError(header)
+    return start, end
+
+
+class DatServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple, idx_files: list):
+        super().__init__(address, DatRequestHandler)
+        self.idx_files = idx_files
+        # every request gets its own thread, so one connection is shared between all of
+        # them instead of opening one per request. lookups are a single indexed query.
+        self.catalog = IdxCatalog(db_path=CATALOG_DB, idx_files=idx_files, check_same_thread=False)
+        self.catalog_lock = threading.Lock()
+        self.rps_cache = OrderedDict()
+        self.rps_lock = threading.Lock()
+
+    def server_close(self):
+        super().server_close()
+        self.catalog.close()
+
+    def find_entry(self, name: str):
+        """Returns the DatEntry for a 16 character name, or None if no idx has it."""
+        try:
+            with self.catalog_lock:
+                location = self.catalog.find_name(name)
+        except ValueError:
+            return None
+        if not location:
+            return None
+        dat_file = os.path.splitext(location["idx_path"])[0] + ".dat" + str(location["dat_num"])
+        return DatEntry(dat_file=dat_file, offset=location["dat_offset"])
+
+    def get_rps(self, name: str, entry: DatEntry) -> RpsFile:
+        """Returns the parsed RPS for an entry, reading it if it isn't cached."""
+        with self.rps_lock:
+            rps = self.rps_cache.get(name)
+            if rps is not None:
+                self.rps_cache.move_to_end(name)
+                return rps
+
+        rps = RpsFile(name, data=entry.data())
+        with self.rps_lock:
+            self.rps_cache[name] = rps
+            while len(self.rps_cache) > RPS_CACHE_SIZE:
+                self.rps_cache.popitem(last=False)
+        return rps
+
+
+class DatRequestHandler(BaseHTTPRequestHandler):
+    server_version = "dat_server"
+
+    def do_HEAD(self):
+        self.handle_request(head=True)
+
+    def do_GET(self):
+        self.handle_request(head=False)
+
+    def handle_request(self, head: bool):
+        path = unquote(urlsplit(self.path).path)
+        parts = path.lstrip("/").split("/", 1)
+
+        if not parts[0]:
+            return self.send_index(head)
+
+        # allow names copied from dump_dat output, which have an extension on them
+        name = parts[0].split(".")[0].lower()
+        entry = self.server.find_entry(name)
+        if entry is None:
+            return self.send_error(HTTPStatus.NOT_FOUND, f"{name} is not in any idx file.")
+
+        if len(parts) == 1:
+            header = entry.peek(HEADER_SIZE)
+            return self.send_data(
+                size=entry.block_table["uncomp_size"],
+                read=entry.read,
+                filename=name + get_extension(header),
+                head=head
+            )
+
+        if get_extension(entry.peek(HEADER_SIZE)) != ".rps":
+            return self.send_error(HTTPStatus.NOT_FOUND, f"{name} is not an RPS file.")
+        rps = self.server.get_rps(name, entry)
+
+        member = parts[1]
+        if not member:
+            return self.send_rps_listing(name, rps, head)
+
+        data = rps.members.get(member.replace("/", "\\"))
+        if data is None:
+            return self.send_error(HTTPStatus.NOT_FOUND, f"{member} is not in {name}.")
+        return self.send_data(
+            size=len(data),
+            read=lambda offset, length: bytes(data[offset:offset+length]),
+            filename=member.split("/")[-1],
+            head=head
+        )
+
+    def send_data(self, size: int, read, filename: str, head: bool):
+        """
+        Sends a file, or the part of it asked for in the Range header.
+
+        :param read: Function that takes (offset, length) and returns those bytes of the file.
+            For dat entries this is DatEntry.read, which only inflates the blocks that cover the range.
+        """
+        try:
+            byte_range = parse_range(self.headers.get("Range"), size)
+        except ValueError:
+            self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        if byte_range:
+            start, end = byte_range
+            self.send_response(HTTPStatus.PARTIAL_CONTENT)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            start, end = 0, size - 1
+            self.send_response(HTTPStatus.OK)
+
+        ext = os.path.splitext(filename)[1]
+        self.send_header("Content-Type", CONTENT_TYPES.get(ext, "application/octet-stream"))
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Content-Disposition", f"inline; filename=\"{filename}\"")
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+
+        if not head and end >= start:
+            self.wfile.write(read(start, end - start + 1))
+
+    def send_html(self, title: str, body: str, head: bool):
+        page = (
+            "<!DOCTYPE html>\n<html>\n<head><meta charset=\"utf-8\">"
+            f"<title>{html.escape(title)}</title></head>\n"
+            f"<body>\n<h1>{html.escape(title)}</h1>\n{body}\n</body>\n</html>\n"
+        ).encode("utf-8")
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(page)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(page)
+
+    def send_index(self, head: bool):
+        rows = "\n".join(f"<li>{html.escape(path)}</li>" for path in self.server.idx_files)
+        body = (
+            "<p>Open <code>/&lt;name&gt;</code> to read a file (ex: <code>/dd2d262c3b39fbd1</code>), "
+            "or <code>/&lt;name&gt;/</code> to browse the files inside of an RPS.</p>\n"
+            f"<p>Serving {len(self.server.idx_files)} idx files:</p>\n<ul>\n{rows}\n</ul>"
+        )
+        self.send_html("dat_server", body, head)
+
+    def send_rps_listing(self, name: str, rps: RpsFile, head: bool):
+        rows = []
+        for member, data in rps.members.items():
+            member = member.replace("\\", "/")
+            rows.append(f"<li><a href=\"/{name}/{quote(member)}\">{html.escape(member)}</a> ({len(data)} bytes)</li>")
+        self.send_html(f"{name}.rps", "<ul>\n" + "\n".join(rows) + "\n</ul>", head)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve files from the game's dats over HTTP without dumping them.")
+    parser.add_argument("-b", "--bind", default="127.0.0.1", help="Address to listen on. Defaults to 127.0.0.1.")
+    parser.add_argument("-p", "--port", type=int, default=8000, help="Port to listen on. Defaults to 8000.")
+    args = parser.parse_args()
+
+    # bring the catalog up to date once; requests only read from it.
+    get_catalog().close()
+
+    server = DatServer((args.bind, args.port), idx_files=get_idx_files())
+    print(f"Serving on http://{args.bind}:{args.port}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
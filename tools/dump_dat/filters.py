@@ -0,0 +1,161 @@
+from struct import unpack
+from tools.lib.extensions import HEADER_SIZE, get_extension
+from tools.lib.idxfile import get_dat_num, get_hashes
+
+# label used for entries whose header doesn't match any known signature
+UNKNOWN_TYPE = "unknown"
+
+
+def get_type(header: bytes) -> str:
+    """Returns the extension for a file's header, or UNKNOWN_TYPE if it isn't known."""
+    return get_extension(header) or UNKNOWN_TYPE
+
+
+def _from_hex(value: str, length: int, error: str) -> bytes:
+    """bytes.fromhex, but raises error if value isn't exactly length hex characters."""
+    try:
+        data = bytes.fromhex(value)
+    except ValueError:
+        data = None
+    if len(value) != length or data is None:
+        raise ValueError(error)
+    return data
+
+
+def parse_folder_hash(value: str) -> int:
+    """
+    Turns a folder hash as it shows up in dumped filenames (the last 8 characters,
+    ex: 669a9b71) into the int stored in the idx. Raises ValueError if it isn't one.
+    """
+    error = f"{value} is not a folder hash. Expected 8 hex characters (ex: 669a9b71)."
+    return unpack("<I", _from_hex(value, 8, error))[0]
+
+
+def parse_file_hash(value: str) -> tuple:
+    """
+    Turns either a full 16 character name (ex: dd2d262c3b39fbd1) or just the
+    8 character file hash half of one into a (file_hash, folder_hash) tuple.
+    folder_hash is None if only the file hash was given. Raises ValueError if it's neither.
+    """
+    error = f"{value} is not a file hash. Expected 16 hex characters (ex: dd2d262c3b39fbd1) or the first 8 of them."
+    if len(value) == 8:
+        return unpack("<I", _from_hex(value, 8, error))[0], None
+    _from_hex(value, 16, error)
+    return get_hashes(value)
+
+
+def read_hash_list(path: str) -> list:
+    """Reads a file with one hash per line. Blank lines and lines starting with # are ignored."""
+    with open(path, "r") as f:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith("#")]
+
+
+class DumpFilter:
+    """
+    Decides which idx entries get dumped. Every check is done as early as it can be:
+
+    - folder hash, file hash and dat number only need the idx record, so entries
+      that fail them are never read from the dat at all
+    - size only needs the entry's block table
+    - type needs the first few bytes of the first block (see DatEntry.peek)
+
+    Nothing that fails a check is ever fully decompressed. An empty filter matches everything.
+    """
+    def __init__(
+        self,
+        folder_hashes: list = None,
+        file_hashes: list = None,
+        types: list = None,
+        dat_nums: list = None,
+        min_size: int = None,
+        max_size: int = None
+    ):
+        """
+        :param folder_hashes: Folder hashes to dump, as ints or 8 character hex strings (ex: 669a9b71).
+        :param file_hashes: Files to dump, as 16 character names (ex: dd2d262c3b39fbd1),
+            8 character file hashes (matches the file in any folder) or (file_hash, folder_hash) tuples.
+        :param types: File types to dump (ex: [".etp", ".rps"], or "unknown").
+        :param dat_nums: Dat numbers to dump (ex: [0, 1]).
+        :param min_size: Only dump entries at least this big (uncompressed, in bytes).
+        :param max_size: Only dump entries at most this big (uncompressed, in bytes).
+        """
+        self.folder_hashes = None
+        if folder_hashes:
+            self.folder_hashes = {
+                parse_folder_hash(folder) if isinstance(folder, str) else folder for folder in folder_hashes
+            }
+
+        self.names = None  # (file_hash, folder_hash) pairs
+        self.any_folder = None  # file hashes given without a folder
+        if file_hashes:
+            self.names = set()
+            self.any_folder = set()
+            for value in file_hashes:
+                file_hash, folder_hash = parse_file_hash(value) if isinstance(value, str) else value
+                if folder_hash is None:
+                    self.any_folder.add(file_hash)
+                else:
+                    self.names.add((file_hash, folder_hash))
+
+        self.types = set(types) if types else None
+        self.dat_nums = {str(dat_num) for dat_num in dat_nums} if dat_nums else None
+        self.min_size = min_size
+        self.max_size = max_size
+
+    def __bool__(self):
+        return any(
+            value is not None
+            for value in (self.folder_hashes, self.names, self.types, self.dat_nums, self.min_size, self.max_size)
+        )
+
+    def match_row(self, records, row: int) -> bool:
+        """
+        Checks the parts of the filter that only need the idx record, for row of an
+        IdxRecords. Reads the row's columns directly rather than building its dict.
+        """
+        if self.dat_nums is not None and str(get_dat_num(records.dat_locs[row])) not in self.dat_nums:
+            return False
+        folder_hash = records.folder_hashes[row]
+        if self.folder_hashes is not None and folder_hash not in self.folder_hashes:
+            return False
+        if self.names is not None:
+            file_hash = records.file_hashes[row]
+            if (file_hash, folder_hash) not in self.names and file_hash not in self.any_folder:
+                return False
+        return True
+
+    def match_size(self, block_table: dict) -> bool:
+        """Checks the size range against an entry's block table."""
+        size = block_table["uncomp_size"]
+        if self.min_size is not None and size < self.min_size:
+            return False
+        if self.max_size is not None and size > self.max_size:
+            return False
+        return True
+
+    def match_type(self, data) -> bool:
+        """Checks the type of a DatEntry. Only the start of the first block is decompressed."""
+        if self.types is None:
+            return True
+        return get_type(data.peek(HEADER_SIZE)) in self.types
+
+    def match_entry(self, data) -> bool:
+        """Checks everything that needs the dat (size, then type) for a DatEntry."""
+        return self.match_size(data.block_table) and self.match_type(data)
+
+    def select_rows(self, idx):
+        """
+        Returns the row numbers in an IdxFile that pass match_row, in idx order. When only
+        some folders or only exact names are wanted, only those rows are looked at.
+        No record dicts are built, so this stays cheap on idx files with a lot of rows.
+        """
+        if self.folder_hashes is None and self.names is None and self.dat_nums is None:
+            return range(len(idx.records))
+        if self.folder_hashes is not None:
+            rows = sorted(row for folder_hash in self.folder_hashes for row in idx.folder_rows(folder_hash))
+        elif self.names is not None and not self.any_folder:
+            keys = ((file_hash << 32) | folder_hash for file_hash, folder_hash in self.names)
+            rows = sorted(idx.hash_index[key] for key in keys if key in idx.hash_index)
+        else:
+            rows = range(len(idx.records))
+        return [row for row in rows if self.match_row(idx.records, row)]
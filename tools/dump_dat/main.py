@@ -1,39 +1,390 @@
+import argparse
 import os
 import sys
+import time
+from collections import Counter
+from itertools import chain, islice
+from concurrent.futures import ProcessPoolExecutor, as_completed
 sys.path.append("../../")  # hack to use tools
-from tools.lib.datfile import DatEntry
-from tools.lib.extensions import EXTENSIONS
-from tools.lib.idxfile import IdxFile
+from tools.dump_dat.filters import DumpFilter, UNKNOWN_TYPE, parse_file_hash, parse_folder_hash, read_hash_list
+from tools.dump_dat.manifest import DumpManifest
+from tools.dump_dat.sinks import SINKS, DedupeSink, DirSink, open_sink
+from tools.lib.datfile import DatEntry, read_entries
+from tools.lib.extensions import HEADER_SIZE, classify, get_extension
+from tools.lib.idxfile import IdxFile, get_dat_num, get_dat_offset
 from tools.lib.rpsfile import RpsFile
 
 # example: C:\Program Files (x86)\SquareEnix\DRAGON QUEST X\Game\Content\Data\data00000000.win32.idx
 idx_file = "C:\\Program Files (x86)\\SquareEnix\\DRAGON QUEST X\\Game\\Content\\Data\\data00000000.win32.idx"
 
-def unpack_idx():
-    idx = IdxFile(idx_file)
+# entries bigger than this (uncompressed) are streamed to disk one block at a time
+# instead of being decompressed into memory first. mostly textures, models and audio.
+STREAM_THRESHOLD = 8 * 1024 * 1024
+
+# entries that are going to be dumped have their block tables parsed this many at a
+# time, so a big idx never has a DatEntry for every row in memory at once.
+READ_BATCH = 1024
+
+# records what has already been dumped so reruns only write what changed.
+# lives in the output folder.
+MANIFEST_NAME = "manifest.db"
+
+
+def hash_arg(parse):
+    """
+    Wraps one of the parse_*_hash functions from filters.py for argparse's type=,
+    so a malformed hash is reported as a usage error instead of a traceback.
+    The value itself is passed through as is; DumpFilter parses it again.
+    """
+    def check(value: str) -> str:
+        try:
+            parse(value)
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(str(e))
+        return value
+    return check
+
+
+def get_dat_file(idx_path: str, dat_num: str) -> str:
+    return os.path.splitext(idx_path)[0] + ".dat" + dat_num
+
+
+def sort_rows(records, rows) -> list:
+    """
+    Sorts idx rows by where their entries are in the dats (dat number, then offset),
+    so each dat is read front to back instead of in idx (hash) order.
+    """
+    def location(row: int) -> tuple:
+        dat_loc = records.dat_locs[row]
+        return get_dat_num(dat_loc), get_dat_offset(dat_loc)
+    return sorted(rows, key=location)
+
+
+def classify_idx(idx_path: str = None, filters: DumpFilter = None, counts: Counter = None) -> Counter:
+    """
+    Counts the entries in an idx by file type and sub-version. Only the first few bytes
+    of each entry are decompressed, so this is much faster than a dump.
+
+    :param filters: Only count the entries that pass this filter.
+    :param counts: Counter to add to. Pass the same one for every idx to classify a whole Data folder.
+    :returns: A Counter of (type, sub-version) -> number of entries. Entries that
+        aren't recognized are counted as (UNKNOWN_TYPE, None).
+    """
+    idx_path = idx_path or idx_file
+    idx = IdxFile(idx_path)
+    filters = filters or DumpFilter()
+    counts = Counter() if counts is None else counts
+    # only the block table and the start of the first block are needed, so this reads
+    # from the dat's map instead of pulling whole entries in with read_entries.
+    for row in sort_rows(idx.records, filters.select_rows(idx)):
+        record = idx.records.record(row)
+        data = DatEntry(dat_file=get_dat_file(idx_path, record["dat_num"]), offset=record["dat_offset"])
+        if filters.match_entry(data):
+            ext, version = classify(data.peek(HEADER_SIZE))
+            counts[(ext or UNKNOWN_TYPE, version)] += 1
+    return counts
+
+
+def print_counts(counts: Counter):
+    """Prints classify_idx's counts, one line per type with its sub-versions under it."""
+    types = Counter()
+    for (ext, version), count in counts.items():
+        types[ext] += count
+    for ext, count in types.most_common():
+        print(f"{ext:<12} {count}")
+        versions = sorted(
+            ((version, count) for (type_, version), count in counts.items() if type_ == ext and version is not None),
+            key=lambda item: str(item[0])
+        )
+        for version, count in versions:
+            print(f"  v{version:<9} {count}")
+    print(f"{'total':<12} {sum(types.values())}")
+
+
+def read_pending(pending, filters: DumpFilter = None):
+    """
+    Yields (key, DatEntry) for entries that are going to be dumped, READ_BATCH at a time.
+    In each batch, entries up to STREAM_THRESHOLD are read in bulk with read_entries.
+    Bigger ones are streamed from the dat's map as they're written, so they're never
+    held in memory whole.
+
+    :param pending: Iterable of (key, dat_file, dat_offset) tuples, in dat offset order.
+    :param filters: Skip entries whose type doesn't pass this filter. Checked from the
+        dat's map, so entries that fail it are never read in full.
+    """
+    pending = iter(pending)
+    while batch := list(islice(pending, READ_BATCH)):
+        entries = [(key, DatEntry(dat_file=dat_file, offset=dat_offset)) for key, dat_file, dat_offset in batch]
+        if filters:
+            entries = [(key, data) for key, data in entries if filters.match_type(data)]
+        small = [(key, data) for key, data in entries if data.block_table["uncomp_size"] <= STREAM_THRESHOLD]
+        for i, data in read_entries(((data.dat_file, data.offset) for key, data in small), order="disk"):
+            yield small[i][0], data
+        for key, data in entries:
+            if data.block_table["uncomp_size"] > STREAM_THRESHOLD:
+                yield key, data
+
+
+def dump_entry(data: DatEntry, dat_file_name: str, filename: str, sink=None):
+    """
+    Writes a single entry as <dat_file_name>/<filename><ext> to sink.
+
+    :param sink: Where to write the entry (see sinks.py). Defaults to the "out" folder.
+    :returns: A (bytes read from the dat, bytes written, output path) tuple, or None if
+        the entry was empty.
+    """
+    if data.block_table["uncomp_size"] > STREAM_THRESHOLD:
+        blocks = data.iter_blocks()
+        file = next(blocks, None)  # the first block is enough to figure out the extension
+        size = data.block_table["uncomp_size"]
+    else:
+        blocks = ()
+        file = data.data()
+        size = len(file) if file else 0
+
+    if not file:
+        return None
+
+    sink = sink or DirSink()
+    filename = filename + get_extension(file)
+    written, path = sink.write(f"{dat_file_name}/{filename}", chain((file,), blocks), size)
+
+    # if filename.split(".")[-1] == "rps":
+    #     rps = RpsFile(f"{os.getcwd()}\\out\\{dat_file_name}\\{filename}")
+    #     rps.dump()
+
+    read = data.block_table["length"] + sum(block["size"] for block in data.block_table["blocks"])
+    return read, written, path
+
+
+def dump_shard(
+    idx_path: str,
+    dat_num: str,
+    shard: list,
+    filters: DumpFilter = None,
+    output: str = "out",
+    dedupe: bool = False
+) -> tuple:
+    """
+    Dumps a list of (filename, dat_offset) entries that all live in the same dat to the
+    output folder. This is what each worker runs in parallel mode; every worker process
+    maps its own copy of the dat.
+
+    :param dedupe: Hardlink entries with the same contents instead of writing them again.
+        Only entries in this shard are compared.
+    :returns: A ((files written, bytes read, bytes written), manifest rows, (duplicates, bytes saved))
+        tuple. Manifest rows are (filename, dat_offset, checksum, path) for every file written.
+    """
+    fq_dat_file = get_dat_file(idx_path, dat_num)
+    dat_file_name = fq_dat_file.split("\\")[-1]
+    sink = DedupeSink(DirSink(output)) if dedupe else DirSink(output)
+    totals = [0, 0, 0]
+    rows = []
+    # sizes and the manifest were already checked before the shards were handed out,
+    # so only types are left. read_pending checks those from the map.
+    pending = ((filename, fq_dat_file, dat_offset) for filename, dat_offset in shard)
+    for filename, data in read_pending(pending, filters):
+        result = dump_entry(data, dat_file_name, filename, sink=sink)
+        if result:
+            totals[0] += 1
+            totals[1] += result[0]
+            totals[2] += result[1]
+            rows.append((filename, data.offset, data.checksum(), result[2]))
+    if dedupe:
+        return tuple(totals), rows, (sink.duplicates, sink.saved)
+    return tuple(totals), rows, (0, 0)
+
+
+def shard_records(records, rows, num_shards: int) -> list:
+    """
+    Splits idx rows into (dat_num, [(filename, dat_offset), ...]) shards.
+    Each shard covers a contiguous offset range of a single dat, so every worker
+    reads its part of the dat front to back.
+
+    :param records: The IdxRecords the rows are from.
+    :param rows: Row numbers to split up.
+    """
+    by_dat = {}
+    for row in rows:
+        record = records.record(row)
+        by_dat.setdefault(record["dat_num"], []).append((record["filename"], record["dat_offset"]))
+
+    shards = []
+    for dat_num, entries in by_dat.items():
+        entries.sort(key=lambda entry: entry[1])
+        shard_size = max(1, -(-len(entries) // num_shards))
+        for i in range(0, len(entries), shard_size):
+            shards.append((dat_num, entries[i:i+shard_size]))
+    return shards
+
+
+def unpack_idx(
+    idx_path: str = None,
+    filters: DumpFilter = None,
+    workers: int = 1,
+    force: bool = False,
+    output: str = "out",
+    dedupe: bool = False
+):
+    """
+    Dumps every entry in an idx to the "out" folder.
+
+    When dumping to a folder, every written entry is recorded in <output>/manifest.db.
+    Entries that were already written by an earlier run (same dat location, same block
+    table checksum and the output file still exists) are skipped, so an interrupted
+    dump picks up where it left off and a dump after a patch only writes what changed.
+
+    :param idx_path: Path to the idx file. Defaults to idx_file at the top of this file.
+    :param filters: Only dump the entries that pass this filter (see DumpFilter). Entries
+        that fail it are skipped before they're decompressed, and entries that fail the
+        idx part of it (folder, file hash, dat number) aren't read at all.
+    :param workers: Number of processes to dump with. 1 dumps on this process.
+    :param force: Dump every entry, even the ones the manifest says are up to date.
+    :param output: Folder to dump to, or a .tar, .zip or .pack file to write every entry
+        into instead (see sinks.py). Archives are always written from scratch, and only
+        a folder can be dumped to with more than one process.
+    :param dedupe: Only write one copy of entries with the same contents. Later copies
+        become hardlinks (folders and tars) or index aliases (packs) to the first one.
+        With more than one worker, entries are only compared within a worker's shard.
+    """
+    idx_path = idx_path or idx_file
+    idx_name = os.path.basename(idx_path.replace("\\", "/"))
+    idx = IdxFile(idx_path)
     num_files = idx.records['count']
     print(f"{num_files} rows found.")
 
-    for record in idx.records["records"]:
-        dat_offset = record["dat_offset"]
-        fq_dat_file = os.path.splitext(idx_file)[0] + ".dat" + record["dat_num"]
-        dat_file_name = fq_dat_file.split("\\")[-1]
-        filename = record["filename"]
+    filters = filters or DumpFilter()
+    records = idx.records
+    rows = filters.select_rows(idx)
+    if filters:
+        print(f"{len(rows)} rows match the idx filters.")
 
-        data = DatEntry(dat_file=fq_dat_file, offset=dat_offset)
-        file = data.data()
-        if file:
-            ext = file[0:7]
-            if ext in EXTENSIONS:
-                filename = filename + EXTENSIONS[ext]
-            os.makedirs(f"out/{dat_file_name}", exist_ok=True)
-            with open(f"out/{dat_file_name}/{filename}", "wb") as f:
-                f.write(file)
+    sink = open_sink(output)
+    if dedupe:
+        if hasattr(sink, "link"):
+            sink = DedupeSink(sink)
+        else:
+            print(f"{output} can't link files together, so every copy will be written.")
+            dedupe = False
+    manifest = None
+    if sink.resumable:
+        manifest = DumpManifest(f"{output}/{MANIFEST_NAME}")
+        if not force:
+            manifest.load(idx_name)
+    elif workers > 1:
+        print(f"-j only works when dumping to a folder. Writing {output} with 1 process.")
+        workers = 1
+
+    start = time.perf_counter()
+    totals = [0, 0, 0]
+    skipped = 0
+    duplicates, saved = 0, 0
 
-            # if filename.split(".")[-1] == "rps":
-            #     rps = RpsFile(f"{os.getcwd()}\\out\\{dat_file_name}\\{filename}")
-            #     rps.dump()
+    # work out what's already been dumped up front from the block tables in the dat's map,
+    # so only what's left is read in full. a rerun with nothing new reads almost nothing.
+    # only (row, dat_offset, checksum) is kept for what's left; the DatEntry is made again
+    # when it's dumped, so memory doesn't grow with a block table per row.
+    pending = []
+    for row in sort_rows(records, rows):
+        record = records.record(row)
+        data = DatEntry(dat_file=get_dat_file(idx_path, record["dat_num"]), offset=record["dat_offset"])
+        if not filters.match_size(data.block_table):
+            continue
+        checksum = data.checksum()
+        if manifest and manifest.is_current(record["filename"], int(record["dat_num"]), record["dat_offset"], checksum):
+            skipped += 1
+        else:
+            pending.append((row, record["dat_offset"], checksum))
+
+    if workers > 1:
+        # several shards per worker so a worker that draws a shard full of
+        # big files doesn't hold up the end of the run.
+        shards = shard_records(records, (row for row, dat_offset, checksum in pending), num_shards=workers * 4)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(dump_shard, idx_path, dat_num, shard, filters, output, dedupe): dat_num for dat_num, shard in shards}
+            for future in as_completed(futures):
+                shard_totals, rows, (shard_duplicates, shard_saved) = future.result()
+                for i, value in enumerate(shard_totals):
+                    totals[i] += value
+                duplicates += shard_duplicates
+                saved += shard_saved
+                for filename, dat_offset, checksum, path in rows:
+                    manifest.record(idx_name, filename, int(futures[future]), dat_offset, checksum, path)
+    else:
+        # types are checked from the map too (in read_pending), then what's left is read
+        # in dat offset order rather than idx (hash) order so the dat is read front to back.
+        entries = (
+            ((row, checksum), get_dat_file(idx_path, str(get_dat_num(records.dat_locs[row]))), dat_offset)
+            for row, dat_offset, checksum in pending
+        )
+        for (row, checksum), data in read_pending(entries, filters):
+            record = records.record(row)
+            dat_file_name = data.dat_file.split("\\")[-1]
+            result = dump_entry(data, dat_file_name, record["filename"], sink=sink)
+            if result:
+                totals[0] += 1
+                totals[1] += result[0]
+                totals[2] += result[1]
+                if manifest:
+                    manifest.record(idx_name, record["filename"], int(record["dat_num"]), record["dat_offset"], checksum, result[2])
+
+    sink.close()
+    if manifest:
+        manifest.close()
+    if dedupe and workers == 1:
+        duplicates, saved = sink.duplicates, sink.saved
+
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    files, read, written = totals
+    print(
+        f"Wrote {files} files in {elapsed:.1f}s "
+        f"({files / elapsed:.0f} files/s, {read / elapsed / 1024 ** 2:.1f} MB/s read, "
+        f"{written / elapsed / 1024 ** 2:.1f} MB/s inflated)."
+    )
+    if dedupe:
+        print(f"Deduped {duplicates} files, saving {saved / 1024 ** 2:.1f} MB.")
+    if skipped:
+        print(f"Skipped {skipped} files that were already dumped. Use -f to dump them again.")
 
 
 if __name__ == "__main__":
-    unpack_idx()
+    parser = argparse.ArgumentParser(description="Dump the files in an idx/dat to the out folder.")
+    parser.add_argument("-i", "--idx", nargs="+", default=[idx_file], help="Path to the idx file(s) to dump. Defaults to idx_file at the top of this file.")
+    parser.add_argument("-c", "--classify", action="store_true", help="Print how many entries of each file type (and version) the idx files have instead of dumping.")
+    parser.add_argument("--dedupe", action="store_true", help="Only write one copy of files with the same contents. The other copies are hardlinked to it (or aliased, in a .pack).")
+    parser.add_argument("-f", "--force", action="store_true", help="Dump every file, even ones out/manifest.db says were already dumped.")
+    parser.add_argument("-o", "--output", default="out", help="Folder to dump to, or a .tar, .zip or .pack file to write every file into instead. Defaults to out.")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of processes to dump with (ex: -j 8). Defaults to 1.")
+    parser.add_argument("-t", "--types", nargs="+", help=f"Only dump these file types (ex: -t .etp .rps). Use \"{UNKNOWN_TYPE}\" for files with an unrecognized header.")
+    parser.add_argument("--folder", nargs="+", type=hash_arg(parse_folder_hash), help="Only dump files in these folders (ex: --folder 669a9b71). This is the last 8 characters of a dumped filename.")
+    parser.add_argument("--hash", nargs="+", type=hash_arg(parse_file_hash), help="Only dump these files (ex: --hash dd2d262c3b39fbd1). Pass just the first 8 characters to match the file in any folder.")
+    parser.add_argument("--hash-list", help="Only dump the files listed in this text file (one hash per line, same format as --hash).")
+    parser.add_argument("-d", "--dat", nargs="+", type=int, help="Only dump files from these dat numbers (ex: -d 0 1).")
+    parser.add_argument("--min-size", type=int, help="Only dump files at least this many bytes (uncompressed).")
+    parser.add_argument("--max-size", type=int, help="Only dump files at most this many bytes (uncompressed).")
+    args = parser.parse_args()
+
+    hashes = (args.hash or []) + (read_hash_list(args.hash_list) if args.hash_list else [])
+    try:
+        filters = DumpFilter(
+            folder_hashes=args.folder,
+            file_hashes=hashes,
+            types=args.types,
+            dat_nums=args.dat,
+            min_size=args.min_size,
+            max_size=args.max_size
+        )
+    except ValueError as e:
+        # --folder and --hash are checked by argparse, so this is a bad line in --hash-list
+        parser.error(f"{args.hash_list}: {e}")
+
+    if args.classify:
+        counts = Counter()
+        for idx_path in args.idx:
+            classify_idx(idx_path=idx_path, filters=filters, counts=counts)
+        print_counts(counts)
+    else:
+        if len(args.idx) > 1 and os.path.splitext(args.output)[1].lower() in SINKS:
+            parser.error("Only one idx can be dumped into an archive at a time.")
+        for idx_path in args.idx:
+            unpack_idx(idx_path=idx_path, filters=filters, workers=args.jobs, force=args.force, output=args.output, dedupe=args.dedupe)
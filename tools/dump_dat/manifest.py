@@ -0,0 +1,74 @@
+import os
+import sqlite3
+
+# rows are committed in batches. if a dump is interrupted, at most this many
+# already written files are dumped again on the next run.
+COMMIT_EVERY = 1000
+
+
+class DumpManifest:
+    """
+    Records every entry dump_dat has written: where it came from in the dat, a checksum
+    of its block table and where it was written to. On the next run, entries whose
+    location and checksum still match (and whose output file still exists) can be
+    skipped, which makes re-dumping after a patch or an interrupted dump fast.
+    """
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS entries (
+                idx TEXT,
+                filename TEXT,
+                dat_num INTEGER,
+                dat_offset INTEGER,
+                checksum INTEGER,
+                path TEXT,
+                PRIMARY KEY (idx, filename)
+            )
+            """
+        )
+        self.rows = {}
+        self._uncommitted = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def load(self, idx: str):
+        """Reads the rows for an idx (by file name, ex: data00000000.win32.idx) into memory."""
+        self.rows = {
+            row[0]: tuple(row[1:])
+            for row in self.conn.execute(
+                "SELECT filename, dat_num, dat_offset, checksum, path FROM entries WHERE idx = ?", (idx,)
+            )
+        }
+
+    def is_current(self, filename: str, dat_num: int, dat_offset: int, checksum: int) -> bool:
+        """True if the entry was already written from the same place and its output is still there."""
+        row = self.rows.get(filename)
+        return row is not None and row[:3] == (dat_num, dat_offset, checksum) and os.path.exists(row[3])
+
+    def record(self, idx: str, filename: str, dat_num: int, dat_offset: int, checksum: int, path: str):
+        """Records a written entry. Only call this once the output file is completely written."""
+        self.conn.execute(
+            "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+            (idx, filename, dat_num, dat_offset, checksum, path)
+        )
+        self.rows[filename] = (dat_num, dat_offset, checksum, path)
+        self._uncommitted += 1
+        if self._uncommitted >= COMMIT_EVERY:
+            self.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self._uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self.conn.close()
@@ -0,0 +1,296 @@
+import os
+import shutil
+import tarfile
+import time
+import zipfile
+from hashlib import sha1
+from itertools import chain
+from tools.lib.packfile import PackWriter
+
+
+class DirSink:
+    """Writes every entry to its own file under root. This is what dump_dat has always done."""
+    resumable = True
+
+    def __init__(self, root: str = "out"):
+        self.root = root
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, name: str, chunks, size: int = None) -> tuple:
+        """
+        Writes an entry to <root>/<name>.
+
+        :param name: "/" separated name of the entry (ex: data00000000.win32.dat0/dd2d262c3b39fbd1.etp).
+        :param chunks: Iterable of bytes-like objects that make up the entry.
+        :param size: Size of the entry, if known. Not needed for this sink.
+        :returns: A (bytes written, path the entry was written to) tuple.
+        """
+        path = f"{self.root}/{name}"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # the old file may be hardlinked to other entries by a deduped dump, so
+        # replace it instead of writing through it.
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        written = 0
+        with open(path, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+                written += len(chunk)
+        return written, path
+
+    def link(self, name: str, target: str) -> str:
+        """
+        Makes <root>/<name> a hardlink to the already written <root>/<target>. Falls back
+        to a copy on filesystems that don't support hardlinks.
+
+        :returns: Path of the link.
+        """
+        path = f"{self.root}/{name}"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.lexists(path):
+            os.remove(path)
+        try:
+            os.link(f"{self.root}/{target}", path)
+        except OSError:
+            shutil.copyfile(f"{self.root}/{target}", path)
+        return path
+
+    def discard(self, name: str):
+        """Removes an entry that was just written."""
+        os.remove(f"{self.root}/{name}")
+
+    def close(self):
+        pass
+
+
+class TarSink:
+    """
+    Writes every entry into a single uncompressed tar. Headers and data are written
+    straight to the file as the entries come in; nothing is buffered besides the
+    chunk being written.
+    """
+    resumable = False
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, "wb")
+        self.mtime = int(time.time())
+        self.last_pos = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _header(self, name: str, size: int, linkname: str = None) -> bytes:
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = self.mtime
+        info.mode = 0o644
+        if linkname is not None:
+            info.type = tarfile.LNKTYPE
+            info.linkname = linkname
+        return info.tobuf(tarfile.GNU_FORMAT, "utf-8", "surrogateescape")
+
+    def write(self, name: str, chunks, size: int = None) -> tuple:
+        """
+        Same as DirSink.write. size is written to the header up front; if the entry
+        turns out to be a different size, the header is rewritten after the data.
+        """
+        header = self._header(name, size or 0)
+        header_pos = self.file.tell()
+        self.last_pos = header_pos
+        self.file.write(header)
+
+        written = 0
+        for chunk in chunks:
+            self.file.write(chunk)
+            written += len(chunk)
+
+        if written != (size or 0):
+            end = self.file.tell()
+            # the header is the same length for any size, so it can be rewritten in place
+            self.file.seek(header_pos)
+            self.file.write(self._header(name, written))
+            self.file.seek(end)
+
+        remainder = written % tarfile.BLOCKSIZE
+        if remainder:
+            self.file.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+        return written, f"{self.path}:{name}"
+
+    def link(self, name: str, target: str) -> str:
+        """Adds a hardlink member (no data) that points at the already written target."""
+        self.last_pos = self.file.tell()
+        self.file.write(self._header(name, 0, linkname=target))
+        return f"{self.path}:{name}"
+
+    def discard(self, name: str):
+        """Truncates the entry that was just written off the end of the tar."""
+        self.file.seek(self.last_pos)
+        self.file.truncate()
+
+    def close(self):
+        if self.file.closed:
+            return
+        # end of archive marker, then pad to a full record like tarfile does
+        self.file.write(tarfile.NUL * (tarfile.BLOCKSIZE * 2))
+        remainder = self.file.tell() % tarfile.RECORDSIZE
+        if remainder:
+            self.file.write(tarfile.NUL * (tarfile.RECORDSIZE - remainder))
+        self.file.close()
+
+
+class ZipSink:
+    """Writes every entry into a single zip with no compression (ZIP_STORED)."""
+    resumable = False
+
+    def __init__(self, path: str):
+        self.path = path
+        self.zip = zipfile.ZipFile(path, "w", compression=zipfile.ZIP_STORED, allowZip64=True)
+        self.date_time = time.localtime()[0:6]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, name: str, chunks, size: int = None) -> tuple:
+        """Same as DirSink.write."""
+        info = zipfile.ZipInfo(name, date_time=self.date_time)
+        written = 0
+        with self.zip.open(info, "w", force_zip64=(size or 0) >= zipfile.ZIP64_LIMIT) as f:
+            for chunk in chunks:
+                f.write(chunk)
+                written += len(chunk)
+        return written, f"{self.path}:{name}"
+
+    def close(self):
+        self.zip.close()
+
+
+class PackSink:
+    """
+    Writes every entry into a single pack file (see tools/lib/packfile.py), which
+    unpack_etp and RpsFile can read members from without extracting anything.
+    """
+    resumable = False
+
+    def __init__(self, path: str):
+        self.path = path
+        self.pack = PackWriter(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, name: str, chunks, size: int = None) -> tuple:
+        """Same as DirSink.write."""
+        return self.pack.write(name, chunks), f"{self.path}:{name}"
+
+    def link(self, name: str, target: str) -> str:
+        """Adds an index entry for name that points at target's data."""
+        self.pack.alias(name, target)
+        return f"{self.path}:{name}"
+
+    def discard(self, name: str):
+        """Truncates the entry that was just written off the end of the pack."""
+        self.pack.discard_last()
+
+    def close(self):
+        self.pack.close()
+
+
+class DedupeSink:
+    """
+    Wraps another sink so that entries with identical contents are only stored once.
+    The first entry with a given sha1 is written as normal; every later entry with the
+    same contents becomes a link to it (a hardlink for folders and tars, an alias in
+    the index for packs). zips have no way to link entries, so they can't be deduped.
+
+    Entries that arrive as a single chunk (everything under dump_dat's STREAM_THRESHOLD)
+    are hashed before they're written, so duplicates cost no writes at all. Streamed
+    entries are hashed as they're written and swapped for a link afterwards.
+    """
+    def __init__(self, sink):
+        if not hasattr(sink, "link"):
+            raise ValueError(f"{type(sink).__name__} can't link entries, so it can't be deduped.")
+        self.sink = sink
+        self.resumable = sink.resumable
+        self.blobs = {}  # sha1 -> name of the entry that holds the data
+        self.duplicates = 0
+        self.saved = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, name: str, chunks, size: int = None) -> tuple:
+        """Same as DirSink.write. The bytes written count includes linked duplicates."""
+        chunks = iter(chunks)
+        first = next(chunks, b"")
+        second = next(chunks, None)
+
+        if second is None:
+            digest = sha1(first).digest()
+            if digest in self.blobs:
+                return self._link(name, self.blobs[digest], len(first))
+            self.blobs[digest] = name
+            return self.sink.write(name, (first,), size)
+
+        hasher = sha1()
+
+        def hashed(chunks):
+            for chunk in chunks:
+                hasher.update(chunk)
+                yield chunk
+
+        written, path = self.sink.write(name, hashed(chain((first, second), chunks)), size)
+        digest = hasher.digest()
+        if digest in self.blobs:
+            self.sink.discard(name)
+            return self._link(name, self.blobs[digest], written)
+        self.blobs[digest] = name
+        return written, path
+
+    def _link(self, name: str, target: str, size: int) -> tuple:
+        path = self.sink.link(name, target)
+        self.duplicates += 1
+        self.saved += size
+        return size, path
+
+    def close(self):
+        self.sink.close()
+
+
+SINKS = {
+    ".tar": TarSink,
+    ".zip": ZipSink,
+    ".pack": PackSink,
+}
+
+
+def open_sink(output: str):
+    """
+    Picks a sink from the output path's extension: .tar, .zip and .pack write a
+    single archive, anything else is treated as a directory.
+    """
+    sink = SINKS.get(os.path.splitext(output)[1].lower())
+    if sink:
+        if os.path.dirname(output):
+            os.makedirs(os.path.dirname(output), exist_ok=True)
+        return sink(output)
+    return DirSink(output)
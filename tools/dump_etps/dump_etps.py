@@ -3,9 +3,10 @@ import glob
 import os
 import sqlite3
 import sys
+from struct import unpack
 sys.path.append("../../")  # hack to use tools
-from tools.lib.datfile import DatEntry
-from tools.lib.extensions import EXTENSIONS
+from tools.lib.datfile import read_entries
+from tools.lib.extensions import get_extension
 from tools.lib.idxfile import IdxFile
 from tools.idx_searcher.main import get_idx_files
 from tools.globals import GAME_DATA_DIR
@@ -18,26 +19,22 @@ DB_PATH = "../import_sql/dat_db.db"
 DB_CONN = sqlite3.connect(DB_PATH)
 DB_CUR = DB_CONN.cursor()
 
+# common/data/eventText/ja/current. all ETP files are here ("669a9b71" in the hex filename)
+EVENT_TEXT_FOLDER_HASH = unpack("<I", bytes.fromhex("669a9b71"))[0]
+
 
 def find_etps():
     found = []
     idx_list = get_idx_files()
     for idx in idx_list:
         file = IdxFile(idx)
-        for record in file.records["records"]:
-            if record["filename"][8:16] == "669a9b71":  # common/data/eventText/ja/current. all ETP files are here
-                idx_file = idx.split("\\")[-1]
-                dat_file = idx_file.replace(".win32.idx", f".win32.dat{record['dat_num']}")
-                found.append({"idx": idx_file, "dat": dat_file, "file": record["filename"][0:8], "dir": record["filename"][8:16], "dat_offset": record["dat_offset"]})
+        for record in file.folder_records(EVENT_TEXT_FOLDER_HASH):
+            idx_file = idx.split("\\")[-1]
+            dat_file = idx_file.replace(".win32.idx", f".win32.dat{record['dat_num']}")
+            found.append({"idx": idx_file, "dat": dat_file, "file": record["filename"][0:8], "dir": record["filename"][8:16], "dat_offset": record["dat_offset"]})
     return found
 
 
-def get_file_data(dat_filename: str, offset: int):
-    dat_file = "/".join([GAME_DATA_DIR, dat_filename])
-    file = DatEntry(dat_file, offset)
-    return file.data()
-
-
 def write_etp(filename: str, data: bytes):
     os.makedirs("etps", exist_ok=True)
     with open(f"etps/{filename}", "w+b") as f:
@@ -96,25 +93,27 @@ def decrypt_file(file: str, agent: object):
 
 def dump_all_etps():
     etps = find_etps()
-    for etp in etps:
+    # read the etps in dat offset order so each dat is read front to back instead of seeking around
+    entries = (("/".join([GAME_DATA_DIR, etp["dat"]]), etp["dat_offset"]) for etp in etps)
+    for i, entry in read_entries(entries, order="disk"):
+        etp = etps[i]
 
         _dat = etp["dat"]
-        _offset = etp["dat_offset"]
         _file = etp["file"]
         _dir = etp["dir"]
         _idx = etp["idx"]
 
-        file_data = get_file_data(dat_filename=_dat, offset=_offset)
+        file_data = entry.data()
         if file_data:
-            ext = file_data[0:7]
+            ext = get_extension(file_data)
             name = get_filename(_file)
             if name:
                 filename = name
             else:
                 # we don't know this file. start tracking it in the db
                 update_db(file_hash=_file, dir_hash=_dir, dat=_dat, idx=_idx)
-                if ext in EXTENSIONS:
-                    filename = _file + EXTENSIONS[ext]
+                if ext:
+                    filename = _file + ext
                 else:
                     filename = (
                         _file + ".cry"
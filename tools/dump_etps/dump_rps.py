@@ -1,8 +1,6 @@
 import argparse
 import glob
 import os
-import pathlib
-import shutil
 import sqlite3
 import sys
 sys.path.append("../../")  # hack to use tools
@@ -15,6 +13,9 @@ from tools.dump_etps.dqxcrypt.dqxcrypt import (
     bruteforce
 )
 
+RPS_FILE = "rps/packageManagerRegistIncludeAutoClient.rps"
+RPS_FOLDER = "rps/packageManagerRegistIncludeAutoClient_rps"
+
 DB_PATH = "../import_sql/dat_db.db"
 DB_CONN = sqlite3.connect(DB_PATH)
 DB_CUR = DB_CONN.cursor()
@@ -29,32 +30,37 @@ def find_rps_etp():
     idx = f"{GAME_DATA_DIR}\\data00000000.win32.idx"
     dat = f"{GAME_DATA_DIR}\\data00000000.win32.dat0"
     file = IdxFile(idx)
-    for record in file.records["records"]:
-        if record["filename"] == "800718ca783ff612":  # special RPS that has all initially loaded ETPs in it
-            return ({"idx": idx, "dat": dat, "file": record["filename"][0:8], "dir": record["filename"][8:16], "dat_offset": record["dat_offset"]})
+    record = file.lookup_name("800718ca783ff612")  # special RPS that has all initially loaded ETPs in it
+    if record:
+        return ({"idx": idx, "dat": dat, "file": record["filename"][0:8], "dir": record["filename"][8:16], "dat_offset": record["dat_offset"]})
     return None
 
 
-def dump_rps_etp():
+def dump_rps_etp() -> bytearray:
+    """
+    Writes the RPS to the rps folder (pack_rps.py builds the new RPS from it)
+    and returns its contents so they can be extracted without reading it back.
+    """
     rps = find_rps_etp()
     rps_file = DatEntry(dat_file=rps["dat"], offset=rps["dat_offset"])
-    rps_data = rps_file.data()
+    rps_data = rps_file.data(threads=os.cpu_count())
     os.makedirs("rps", exist_ok=True)
-    with open("rps/packageManagerRegistIncludeAutoClient.rps", "w+b") as f:
+    with open(RPS_FILE, "w+b") as f:
         f.write(rps_data)
+    return rps_data
 
 
-def extract_rps():
-    rps = ".\\rps\\packageManagerRegistIncludeAutoClient.rps"
-    rps_data = RpsFile(rps)
-    rps_data.dump()
-
+def extract_rps(rps_data: bytes = None):
+    """
+    Extracts every file in the RPS to the rps folder and copies the ETPs to the etps folder.
+    Both are written straight from rps_data (or the dumped RPS, if it isn't passed).
+    """
+    rps = RpsFile(RPS_FILE, data=rps_data)
+    rps.extract(dest=RPS_FOLDER)
 
-def move_etps_to_etp_dir():
-    files = glob.glob("rps/packageManagerRegistIncludeAutoClient_rps/*.etp")
-    pathlib.Path("etps").mkdir(exist_ok=True)
-    for file in files:
-        shutil.copy2(src=file, dst=f"etps/{os.path.basename(file)}")
+    # only the top level .etp files. encrypted ones are .etp.cry and get decrypted separately.
+    etps = [name for name in rps.members if "\\" not in name and rps.output_name(name).endswith(".etp")]
+    rps.extract(names=etps, dest="etps")
 
 
 def decrypt_cry_files():
@@ -65,12 +71,12 @@ def decrypt_cry_files():
     if not os.path.exists("rps"):
         sys.exit("Dump the RPS first and then attempt to decrypt.")
     agent = attach_client()
-    files = glob.glob("rps/packageManagerRegistIncludeAutoClient_rps/*.etp.cry")
+    files = glob.glob(f"{RPS_FOLDER}/*.etp.cry")
     for file in files:
         bruteforce(
             agent=agent,
             filepath=file,
-            managed_package_data_client_path="rps/packageManagerRegistIncludeAutoClient_rps/ManagedPackageDataClient.win32.pkg"
+            managed_package_data_client_path=f"{RPS_FOLDER}/ManagedPackageDataClient.win32.pkg"
         )
         new_name = file.split(".cry")[0]
         os.replace(src=f"{file}.dec", dst=new_name)
@@ -87,8 +93,7 @@ if __name__ == "__main__":
     if args.u and args.d:
         sys.exit("Please specify either one argument or the other; not both.")
     if args.u:
-        dump_rps_etp()
-        extract_rps()
-        move_etps_to_etp_dir()
+        rps_data = dump_rps_etp()
+        extract_rps(rps_data)
     elif args.d:
         decrypt_cry_files()
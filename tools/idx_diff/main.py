@@ -0,0 +1,191 @@
+"""
+This script compares two snapshots of the game's idx files and reports
+which entries were added, removed or relocated between them. Relocated entries
+are split into ones whose content changed and ones that were only moved, by
+comparing their dat block tables and compressed bytes (nothing is decompressed).
+"""
+
+import argparse
+import glob
+import json
+import os
+import shutil
+import sys
+import zlib
+sys.path.append("../../")  # hack to use tools
+from tools.lib.datfile import DatEntry
+from tools.lib.idxfile import IdxFile, get_dat_num, get_dat_offset, get_filename
+
+
+def get_idx_files(snapshot_dir: str) -> dict:
+    """
+    Returns every idx file under snapshot_dir, keyed on its path relative to snapshot_dir.
+    Point this at Game/Content to pick up both the base Data folder and the Ex*/Data folders.
+    """
+    idx_files = glob.glob(os.path.join(snapshot_dir, "**", "*.idx"), recursive=True)
+    return {os.path.relpath(idx, snapshot_dir).replace("\\", "/"): idx for idx in idx_files}
+
+
+def snapshot_idx_files(src_dir: str, dest_dir: str) -> list:
+    """Copies every idx file under src_dir into dest_dir, keeping the folder layout."""
+    copied = []
+    for rel_path, idx in get_idx_files(src_dir).items():
+        dest = os.path.join(dest_dir, rel_path)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        shutil.copy2(src=idx, dst=dest)
+        copied.append(dest)
+    return copied
+
+
+def read_dat_locs(idx: str) -> dict:
+    """Maps (file_hash << 32 | folder_hash) to the packed dat location for every record in an idx."""
+    records = IdxFile(idx).records
+    file_hashes = records.file_hashes
+    folder_hashes = records.folder_hashes
+    return {
+        (file_hashes[i] << 32) | folder_hashes[i]: records.dat_locs[i]
+        for i in range(records.count - 1, -1, -1)
+    }
+
+
+def entry_fingerprint(dat_file: str, offset: int):
+    """
+    Returns a (block layout, crc32 of the compressed blocks) tuple for an entry without
+    decompressing it, or None if there isn't a readable entry at the offset.
+    """
+    try:
+        entry = DatEntry(dat_file=dat_file, offset=offset)
+        table = entry.block_table
+        if not table:
+            return None
+        blocks = table["blocks"]
+        layout = (table["type"], table["uncomp_size"], tuple((b["size"], b["decomp_size"]) for b in blocks))
+        crc = 0
+        for block in blocks:
+            with entry.reader.view(block["start_loc"], block["size"]) as raw:
+                crc = zlib.crc32(raw, crc)
+    except Exception:
+        return None
+    return layout, crc
+
+
+def _location(key: int, dat_loc: int) -> dict:
+    return {
+        "filename": get_filename(key >> 32, key & 0xFFFFFFFF),
+        "dat_num": get_dat_num(dat_loc),
+        "dat_offset": get_dat_offset(dat_loc)
+    }
+
+
+def diff_idx(old_idx: str, new_idx: str, old_dat_dir: str = None, new_dat_dir: str = None) -> dict:
+    """
+    Compares two versions of the same idx file.
+
+    :param old_idx: Path to the old idx (or None if the idx is new).
+    :param new_idx: Path to the new idx (or None if the idx was removed).
+    :param old_dat_dir: Folder with the old dat files. Defaults to the old idx's folder.
+        If an old dat isn't found there, the new dat is read at the old offset instead
+        (patches append to the dats, so the old entry is usually still there).
+    :param new_dat_dir: Folder with the new dat files. Defaults to the new idx's folder.
+    :returns: A dict of added, removed, changed, moved and unverified entry lists, plus
+        an unchanged count. Relocated entries that couldn't be read are "unverified".
+    """
+    old_locs = read_dat_locs(old_idx) if old_idx else {}
+    new_locs = read_dat_locs(new_idx) if new_idx else {}
+
+    result = {
+        "added": [_location(key, new_locs[key]) for key in new_locs.keys() - old_locs.keys()],
+        "removed": [_location(key, old_locs[key]) for key in old_locs.keys() - new_locs.keys()],
+        "changed": [],
+        "moved": [],
+        "unverified": [],
+        "unchanged": 0
+    }
+
+    relocated = [key for key in old_locs.keys() & new_locs.keys() if old_locs[key] != new_locs[key]]
+    result["unchanged"] = len(old_locs.keys() & new_locs.keys()) - len(relocated)
+    if not relocated:
+        return result
+
+    old_dat_dir = old_dat_dir or os.path.dirname(old_idx)
+    new_dat_dir = new_dat_dir or os.path.dirname(new_idx)
+    old_base = os.path.splitext(os.path.basename(old_idx))[0]
+    new_base = os.path.splitext(os.path.basename(new_idx))[0]
+
+    # read in dat offset order so the dats are walked front to back
+    relocated.sort(key=lambda key: (get_dat_num(new_locs[key]), get_dat_offset(new_locs[key])))
+    for key in relocated:
+        old_loc, new_loc = old_locs[key], new_locs[key]
+        entry = _location(key, new_loc)
+        entry.update({"old_dat_num": get_dat_num(old_loc), "old_dat_offset": get_dat_offset(old_loc)})
+
+        new_dat = os.path.join(new_dat_dir, f"{new_base}.dat{get_dat_num(new_loc)}")
+        old_dat = os.path.join(old_dat_dir, f"{old_base}.dat{get_dat_num(old_loc)}")
+        if not os.path.exists(old_dat):
+            old_dat = os.path.join(new_dat_dir, f"{new_base}.dat{get_dat_num(old_loc)}")
+
+        old_print = entry_fingerprint(dat_file=old_dat, offset=get_dat_offset(old_loc)) if os.path.exists(old_dat) else None
+        new_print = entry_fingerprint(dat_file=new_dat, offset=get_dat_offset(new_loc)) if os.path.exists(new_dat) else None
+
+        if old_print is None or new_print is None:
+            result["unverified"].append(entry)
+        elif old_print == new_print:
+            result["moved"].append(entry)
+        else:
+            result["changed"].append(entry)
+
+    return result
+
+
+def diff_idx_sets(old_dir: str, new_dir: str) -> dict:
+    """
+    Compares every idx file between two snapshot folders, matching idx files
+    by their path relative to each folder.
+
+    :returns: A dict of relative idx path -> diff_idx result. idx files with no
+        differences are left out.
+    """
+    old_files = get_idx_files(old_dir)
+    new_files = get_idx_files(new_dir)
+
+    results = {}
+    for rel_path in sorted(old_files.keys() | new_files.keys()):
+        old_idx = old_files.get(rel_path)
+        new_idx = new_files.get(rel_path)
+        result = diff_idx(
+            old_idx=old_idx,
+            new_idx=new_idx,
+            old_dat_dir=os.path.dirname(old_idx) if old_idx else None,
+            new_dat_dir=os.path.dirname(new_idx) if new_idx else os.path.dirname(os.path.join(new_dir, rel_path))
+        )
+        if any(result[k] for k in ("added", "removed", "changed", "moved", "unverified")):
+            results[rel_path] = result
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare two snapshots of the game's idx files and report what changed.")
+    parser.add_argument("old_dir", type=str, help="Folder with the old idx files (ex: a snapshot of Game/Content taken before a patch).")
+    parser.add_argument("new_dir", type=str, help="Folder with the new idx files (ex: Game/Content).")
+    parser.add_argument("-o", "--output", type=str, help="Write the full diff as JSON to this file.")
+    parser.add_argument("-s", "--snapshot", action="store_true", help="Instead of diffing, copy every idx file in old_dir into new_dir.")
+    args = parser.parse_args()
+
+    if args.snapshot:
+        copied = snapshot_idx_files(src_dir=args.old_dir, dest_dir=args.new_dir)
+        print(f"Copied {len(copied)} idx files to {args.new_dir}.")
+        sys.exit()
+
+    results = diff_idx_sets(old_dir=args.old_dir, new_dir=args.new_dir)
+    if not results:
+        print("No differences found.")
+    for rel_path, result in results.items():
+        print(
+            f"{rel_path}: {len(result['added'])} added, {len(result['removed'])} removed, "
+            f"{len(result['changed'])} changed, {len(result['moved'])} moved, "
+            f"{len(result['unverified'])} unverified, {result['unchanged']} unchanged"
+        )
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
@@ -6,11 +6,17 @@ It returns a dictionary with the matching idx and dat file.
 
 import argparse
 import glob
+import os
 import sys
 sys.path.append("../../")  # hack to use tools
-from tools.lib.idxfile import IdxFile
+from tools.lib.catalog import IdxCatalog
+from tools.lib.idxfile import get_hashes
 from tools.globals import GAME_DATA_DIR
 
+# persistent hash -> location catalog across all idx files. rebuilt per idx
+# file only when that idx file changes on disk.
+CATALOG_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "idx_catalog.db")
+
 
 def get_idx_files() -> list:
     # idx files are found in base Data and xpac Data folders
@@ -19,17 +25,24 @@ def get_idx_files() -> list:
     return idx_files
 
 
+def get_catalog() -> IdxCatalog:
+    """Opens the idx catalog and brings it up to date with the idx files on disk."""
+    catalog = IdxCatalog(db_path=CATALOG_DB, idx_files=get_idx_files())
+    catalog.refresh()
+    return catalog
+
+
 def find_file(filename: str):
-    found = []
-    idx_list = get_idx_files()
-    for idx in idx_list:
-        file = IdxFile(idx)
-        for record in file.records["records"]:
-            if filename.lower() == record["filename"]:
-                idx_file = idx.split("\\")[-1]
-                dat_file = idx_file.replace(".win32.idx", f".win32.dat{record['dat_num']}")
-                return {"idx": idx_file, "idx_offset": record["idx_offset"], "dat": dat_file, "dat_offset": record["dat_offset"]}
-    return {}
+    """
+    Returns where a 16 character hex name (ex: dd2d262c3b39fbd1) is in the game's idx
+    files, or an empty dict if no idx file has it or it isn't a valid name.
+    """
+    try:
+        file_hash, folder_hash = get_hashes(filename)
+    except ValueError:
+        return {}
+    with get_catalog() as catalog:
+        return catalog.find(file_hash, folder_hash)
 
 
 def reverse_hex_string_le(hex_str: str):
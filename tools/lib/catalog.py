@@ -0,0 +1,139 @@
+import os
+import sqlite3
+from binascii import hexlify
+from struct import unpack
+from .idxfile import (
+    IdxFile,
+    SMPK_FORMAT,
+    SMPK_SIZE,
+    STRUCT_SIZE,
+    RECORD_SIZE,
+    get_dat_num,
+    get_dat_offset,
+    get_hashes
+)
+
+
+class IdxCatalog:
+    """
+    On-disk catalog of every record across a set of idx files, stored in sqlite.
+
+    Each idx file is keyed on its size, mtime and SMPK SHA1. refresh() only re-reads
+    the idx files where one of those changed, so after the first build a lookup is a
+    couple of stat calls and a single indexed query instead of parsing every idx.
+    """
+    def __init__(self, db_path: str, idx_files: list, check_same_thread: bool = True):
+        """
+        :param check_same_thread: Passed to sqlite3.connect. Set to False to share one catalog
+            between threads; the caller is then responsible for only using it from one at a time.
+        """
+        self.db_path = db_path
+        self.idx_files = idx_files
+        self.conn = sqlite3.connect(db_path, check_same_thread=check_same_thread)
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS idx_files (
+                path TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime INTEGER,
+                sha1 TEXT
+            );
+            CREATE TABLE IF NOT EXISTS entries (
+                file_hash INTEGER,
+                folder_hash INTEGER,
+                path TEXT,
+                idx_offset INTEGER,
+                dat_num INTEGER,
+                dat_offset INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS entries_hash ON entries(file_hash, folder_hash);
+            CREATE INDEX IF NOT EXISTS entries_path ON entries(path);
+            """
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    @staticmethod
+    def _idx_key(path: str) -> tuple:
+        """Returns the (size, mtime, sha1) tuple used to tell if an idx file changed."""
+        stat = os.stat(path)
+        with open(path, "rb") as f:
+            sha1 = hexlify(unpack(SMPK_FORMAT, f.read(SMPK_SIZE))[3]).decode()
+        return stat.st_size, stat.st_mtime_ns, sha1
+
+    def refresh(self) -> list:
+        """
+        Brings the catalog up to date with the idx files on disk.
+        Returns the list of idx files that had to be (re)read.
+        """
+        cur = self.conn.cursor()
+        stored = {row[0]: tuple(row[1:]) for row in cur.execute("SELECT path, size, mtime, sha1 FROM idx_files")}
+
+        rebuilt = []
+        for path in self.idx_files:
+            key = self._idx_key(path)
+            if stored.get(path) == key:
+                continue
+
+            records = IdxFile(path).records
+            rows = (
+                (
+                    records.file_hashes[i],
+                    records.folder_hashes[i],
+                    path,
+                    SMPK_SIZE + STRUCT_SIZE + i * RECORD_SIZE,
+                    get_dat_num(records.dat_locs[i]),
+                    get_dat_offset(records.dat_locs[i])
+                )
+                for i in range(records.count)
+            )
+            cur.execute("DELETE FROM entries WHERE path = ?", (path,))
+            cur.executemany("INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?)", rows)
+            cur.execute("INSERT OR REPLACE INTO idx_files VALUES (?, ?, ?, ?)", (path, *key))
+            rebuilt.append(path)
+
+        # idx files that no longer exist shouldn't answer lookups
+        for path in stored.keys() - set(self.idx_files):
+            cur.execute("DELETE FROM entries WHERE path = ?", (path,))
+            cur.execute("DELETE FROM idx_files WHERE path = ?", (path,))
+
+        self.conn.commit()
+        return rebuilt
+
+    def find(self, file_hash: int, folder_hash: int) -> dict:
+        """
+        Returns the location of a file + folder hash pair in the same format as
+        idx_searcher's find_file, or an empty dict if no idx file has it.
+        "idx_path" and "dat_num" are there for callers that need to open the dat.
+        If more than one idx has the pair, the first one in idx_files wins.
+        """
+        rows = self.conn.execute(
+            "SELECT path, idx_offset, dat_num, dat_offset FROM entries WHERE file_hash = ? AND folder_hash = ?",
+            (file_hash, folder_hash)
+        ).fetchall()
+        if not rows:
+            return {}
+
+        order = {path: i for i, path in enumerate(self.idx_files)}
+        path, idx_offset, dat_num, dat_offset = min(rows, key=lambda row: (order.get(row[0], len(order)), row[1]))
+        idx_file = path.split("\\")[-1]
+        dat_file = idx_file.replace(".win32.idx", f".win32.dat{dat_num}")
+        return {
+            "idx": idx_file,
+            "idx_offset": idx_offset,
+            "dat": dat_file,
+            "dat_offset": dat_offset,
+            "idx_path": path,
+            "dat_num": dat_num
+        }
+
+    def find_name(self, filename: str) -> dict:
+        """Same as find, but takes the 16 character hex name (ex: dd2d262c3b39fbd1)."""
+        return self.find(*get_hashes(filename))
@@ -1,66 +1,517 @@
-from struct import unpack
-from zlib import decompress
+import io
+import mmap
+import os
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import accumulate
+from struct import iter_unpack, unpack_from
+from zlib import crc32, decompress, decompressobj
+
+BLOCK_TABLE_HEADER_SIZE = 24
+BLOCK_HEADER_SIZE = 16
+BLOCK_CACHE_SIZE = 64 * 1024 * 1024
+READ_AHEAD_SIZE = 16 * 1024 * 1024
+MIN_READ_SIZE = 128 * 1024
+# a read only carries on past a gap between requested entries if the gap is smaller than this.
+# reading through a small gap is cheaper than a seek; reading through a big one isn't.
+MAX_READ_GAP = 1024 * 1024
+
+# entries with fewer blocks than this are always decompressed on the calling thread,
+# even when threads are asked for. not worth the hand-off for small files.
+PARALLEL_MIN_BLOCKS = 8
+
+_executors = {}
+
+
+def _get_executor(threads: int) -> ThreadPoolExecutor:
+    """Returns a shared thread pool with the given number of workers."""
+    executor = _executors.get(threads)
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="dat_inflate")
+        _executors[threads] = executor
+    return executor
+
+
+class DatReader:
+    """
+    Memory maps a dat file once and hands out DatEntry objects that read from the map.
+
+    Dat files are several GB, so opening and closing them for every entry adds up
+    quickly when dumping a whole idx. Keep one of these around for the whole run
+    (or use DatPool / the module level DEFAULT_POOL, which does that for you).
+    """
+    def __init__(self, dat_file: str):
+        self.dat_file = dat_file
+        self._file = open(dat_file, "rb")
+        self.map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.map.close()
+        self._file.close()
+
+    def _remap(self):
+        """
+        Maps the file again. Needed if the dat was appended to after it was mapped.
+        The old map isn't closed, since other threads may still have views of it.
+        It's unmapped once the last of those views is released.
+        """
+        self.map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def view(self, start: int, length: int) -> memoryview:
+        """
+        Returns a zero-copy view of length bytes at start.
+        Don't hold on to it; the reader can't be closed while a view is alive.
+        """
+        if start + length > len(self.map):
+            # only map again if the dat actually grew; anything else is a bad offset
+            if os.fstat(self._file.fileno()).st_size > len(self.map):
+                self._remap()
+            if start + length > len(self.map):
+                raise ValueError(f"{start}:{start + length} is past the end of {self.dat_file} ({len(self.map)} bytes).")
+        return memoryview(self.map)[start:start+length]
+
+    def entry(self, offset: int):
+        return DatEntry(dat_file=self.dat_file, offset=offset, reader=self)
+
+
+class DatSpan:
+    """
+    A contiguous chunk of a dat file that was read into memory in one go.
+    Has the same view() as DatReader, so DatEntry can read from it. See read_entries().
+    """
+    def __init__(self, dat_file: str, start: int, data: bytes):
+        self.dat_file = dat_file
+        self.start = start
+        self.end = start + len(data)
+        self.data = data
+
+    def contains(self, start: int, length: int) -> bool:
+        return self.start <= start and start + length <= self.end
+
+    def view(self, start: int, length: int) -> memoryview:
+        if not self.contains(start, length):
+            raise ValueError(f"{start}:{start + length} is outside of this span ({self.start}:{self.end}).")
+        return memoryview(self.data)[start-self.start:start-self.start+length]
+
+
+class DatPool:
+    """Keeps one DatReader open per dat file. Safe to share between threads."""
+    def __init__(self):
+        self.readers = {}
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get(self, dat_file: str) -> DatReader:
+        reader = self.readers.get(dat_file)
+        if reader is None:
+            with self.lock:
+                reader = self.readers.get(dat_file)
+                if reader is None:
+                    reader = DatReader(dat_file)
+                    self.readers[dat_file] = reader
+        return reader
+
+    def entry(self, dat_file: str, offset: int):
+        return self.get(dat_file).entry(offset)
+
+    def close(self):
+        for reader in self.readers.values():
+            reader.close()
+        self.readers.clear()
+
+
+# used by DatEntry when it isn't given a reader, so DatEntry(dat_file, offset)
+# shares one map per dat file across the whole process.
+DEFAULT_POOL = DatPool()
+
+
+class BlockCache:
+    """
+    Size-bounded LRU of decompressed blocks, keyed on (dat_file, block start_loc).
+    Shared across entries so reading around inside one file doesn't inflate the
+    same block twice.
+    """
+    def __init__(self, max_size: int = BLOCK_CACHE_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.blocks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple):
+        with self._lock:
+            block = self.blocks.get(key)
+            if block is not None:
+                self.blocks.move_to_end(key)
+            return block
+
+    def put(self, key: tuple, block: bytes):
+        if len(block) > self.max_size:
+            return
+        with self._lock:
+            old = self.blocks.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.blocks[key] = block
+            self.size += len(block)
+            while self.size > self.max_size:
+                _, evicted = self.blocks.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self.blocks.clear()
+            self.size = 0
+
+
+# used by DatEntry.read() and DatEntry.open() when an entry isn't given its own cache.
+DEFAULT_CACHE = BlockCache()
+
+
+class DatEntryIO(io.RawIOBase):
+    """Read-only, seekable file object over a DatEntry. Returned by DatEntry.open()."""
+    def __init__(self, entry):
+        self.entry = entry
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self.pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.entry.block_table["uncomp_size"] + offset
+        else:
+            raise ValueError(f"Invalid whence ({whence}).")
+        if pos < 0:
+            raise ValueError("Negative seek position.")
+        self.pos = pos
+        return self.pos
+
+    def readinto(self, buffer):
+        data = self.entry.read(self.pos, len(buffer))
+        buffer[:len(data)] = data
+        self.pos += len(data)
+        return len(data)
 
 
 class DatEntry:
-    def __init__(self, dat_file: str, offset: int):
+    def __init__(self, dat_file: str, offset: int, reader: DatReader = None, cache: BlockCache = None):
         self.dat_file = dat_file
         self.offset = offset
+        self.reader = reader or DEFAULT_POOL.get(dat_file)
+        self.cache = cache or DEFAULT_CACHE
 
         self.block_table = self.block_table(offset=self.offset)
+        self._block_starts = None
 
     def block_table(self, offset: int):
-        with open(self.dat_file, "rb") as f:
-            f.seek(offset)
-            data = unpack("<I I I I I I", f.read(24))
-
-            blocks = []
-            table = {
-                "length": data[0],
-                "type": data[1],  # 0x01 - Empty, 0x02 - Binary, 0x03 - Model, 0x04 - Texture
-                "uncomp_size": data[2],
-                "unknown": data[3],
-                "block_buffer_size": data[4],  # buffer size needed to read largest block
-                "num_blocks": data[5],
-                "blocks": blocks
-            }
-
-            count = 0
-            while count < table["num_blocks"]:
-                data = unpack("<I H H", f.read(8))
+        with self.reader.view(offset, BLOCK_TABLE_HEADER_SIZE) as header:
+            data = unpack_from("<I I I I I I", header)
+
+        blocks = []
+        table = {
+            "length": data[0],
+            "type": data[1],  # 0x01 - Empty, 0x02 - Binary, 0x03 - Model, 0x04 - Texture
+            "uncomp_size": data[2],
+            "unknown": data[3],
+            "block_buffer_size": data[4],  # buffer size needed to read largest block
+            "num_blocks": data[5],
+            "blocks": blocks
+        }
+
+        with self.reader.view(offset + BLOCK_TABLE_HEADER_SIZE, table["num_blocks"] * 8) as block_data:
+            for block_offset, size, decomp_size in iter_unpack("<I H H", block_data):
                 block = {
-                    "offset": data[0],
-                    "size": data[1],
-                    "decomp_size": data[2],
-                    "start_loc": offset + table["length"] + data[0]
+                    "offset": block_offset,
+                    "size": size,
+                    "decomp_size": decomp_size,
+                    "start_loc": offset + table["length"] + block_offset
                 }
 
                 blocks.append(block)
-                count += 1
-
-            if table["num_blocks"] == len(table["blocks"]):
-                return table
 
-            return None
+        if table["num_blocks"] == len(table["blocks"]):
+            return table
 
-    def data(self):
-        with open(self.dat_file, "rb") as f:
-            blocks = self.block_table["blocks"]
-            game_data = b""
-            for block in blocks:
-                f.seek(block["start_loc"])
-                header = unpack("<I 4x I I", f.read(16))
+        return None
 
-                h_length = header[0]
-                comp_length = header[1]
-                uncomp_length = header[2]
+    def data(self, threads: int = 0):
+        """
+        Returns the decompressed entry as a bytearray, or False if the entry is empty.
+        The output is allocated once from the block table's uncomp_size and every block
+        is decompressed straight into its slice.
 
-                if comp_length == 128000:  # file is not actually compressed, just read decompressed bytes
-                    game_data = game_data + f.read(uncomp_length)
-                else:
-                    result = f.read(comp_length)
-                    game_data = game_data + decompress(result, wbits=-15)
+        :param threads: If more than 1, blocks are inflated on a pool of this many threads.
+            zlib releases the GIL, so this scales with cores on entries with many blocks.
+        """
+        game_data = bytearray(self.block_table["uncomp_size"])
+        size = self.data_into(game_data, threads=threads)
 
-        if game_data:
+        if size:
+            if size != len(game_data):
+                del game_data[size:]
             return game_data
         return False
+
+    def data_into(self, buffer, threads: int = 0) -> int:
+        """
+        Decompresses the entry into buffer (a bytearray, memoryview or anything else that
+        supports the writable buffer protocol), starting at the beginning of it.
+        Useful for reusing one buffer across many entries.
+
+        :param buffer: Buffer that is at least block_table["uncomp_size"] bytes long.
+        :param threads: Same as data().
+        :returns: Number of bytes written.
+        """
+        with memoryview(buffer) as view:
+            if len(view) < self.block_table["uncomp_size"]:
+                raise ValueError(f"Buffer is {len(view)} bytes, but entry needs {self.block_table['uncomp_size']} bytes.")
+
+            # work out where every block lands in the output first, so each block can be
+            # written to its own slice in any order.
+            jobs = []
+            pos = 0
+            for block in self.block_table["blocks"]:
+                data_loc, comp_length, uncomp_length = self._block_header(block)
+                jobs.append((view[pos:pos+uncomp_length], data_loc, comp_length, uncomp_length))
+                pos += uncomp_length
+
+            if threads > 1 and len(jobs) >= PARALLEL_MIN_BLOCKS:
+                # list() to wait for every block and re-raise any errors
+                list(_get_executor(threads).map(lambda job: self._inflate_into(*job), jobs))
+            else:
+                for job in jobs:
+                    self._inflate_into(*job)
+
+            for job in jobs:
+                job[0].release()
+
+        return pos
+
+    def _inflate_into(self, out: memoryview, data_loc: int, comp_length: int, uncomp_length: int):
+        if comp_length == 128000:  # file is not actually compressed, just read decompressed bytes
+            with self.reader.view(data_loc, uncomp_length) as raw:
+                out[:] = raw
+        else:
+            with self.reader.view(data_loc, comp_length) as raw:
+                out[:] = decompress(raw, wbits=-15)
+
+    def iter_blocks(self):
+        """
+        Yields the entry one decompressed block at a time, so only a single block
+        (at most block_buffer_size bytes) has to be in memory at once.
+        """
+        for block in self.block_table["blocks"]:
+            yield self._decompress_block(block)
+
+    def copy_to(self, file_obj: object) -> int:
+        """
+        Streams the decompressed entry into file_obj one block at a time.
+        Returns the number of bytes written.
+        """
+        written = 0
+        for chunk in self.iter_blocks():
+            file_obj.write(chunk)
+            written += len(chunk)
+        return written
+
+    def read(self, offset: int, length: int) -> bytes:
+        """
+        Returns length bytes of the decompressed entry starting at offset.
+        Only the blocks that cover the range are decompressed, and they're kept in
+        the block cache for the next read.
+        """
+        if self._block_starts is None:
+            # uncompressed position of each block within the entry
+            self._block_starts = [0, *accumulate(block["decomp_size"] for block in self.block_table["blocks"])]
+
+        end = min(offset + length, self.block_table["uncomp_size"])
+        if offset >= end:
+            return b""
+
+        blocks = self.block_table["blocks"]
+        out = bytearray()
+        i = bisect_right(self._block_starts, offset) - 1
+        while i < len(blocks) and self._block_starts[i] < end:
+            block = self._cached_block(i)
+            start = self._block_starts[i]
+            out += block[max(offset - start, 0):end - start]
+            i += 1
+
+        return bytes(out)
+
+    def checksum(self) -> int:
+        """
+        Returns a crc32 of the raw block table. Cheap to get (no block data is read)
+        and changes whenever the entry is rewritten with different sizes.
+        """
+        with self.reader.view(self.offset, BLOCK_TABLE_HEADER_SIZE + self.block_table["num_blocks"] * 8) as raw:
+            return crc32(raw)
+
+    def peek(self, n: int) -> bytes:
+        """
+        Returns (up to) the first n bytes of the decompressed entry. Only the start of
+        the first block is inflated, or read as-is if the block is stored uncompressed.
+        Meant for figuring out what type of file an entry is.
+        """
+        blocks = self.block_table["blocks"]
+        if not blocks or n <= 0:
+            return b""
+        if n > blocks[0]["decomp_size"]:
+            return self.read(0, n)
+
+        data_loc, comp_length, uncomp_length = self._block_header(blocks[0])
+        if comp_length == 128000:  # file is not actually compressed, just read decompressed bytes
+            with self.reader.view(data_loc, min(n, uncomp_length)) as raw:
+                return bytes(raw)
+        with self.reader.view(data_loc, comp_length) as raw:
+            return decompressobj(wbits=-15).decompress(raw, n)
+
+    def open(self):
+        """Returns a seekable, read-only file object over the decompressed entry."""
+        return io.BufferedReader(DatEntryIO(self))
+
+    def _cached_block(self, i: int) -> bytes:
+        block = self.block_table["blocks"][i]
+        key = (self.dat_file, block["start_loc"])
+        data = self.cache.get(key)
+        if data is None:
+            data = self._decompress_block(block)
+            self.cache.put(key, data)
+        return data
+
+    def _decompress_block(self, block: dict) -> bytes:
+        data_loc, comp_length, uncomp_length = self._block_header(block)
+        if comp_length == 128000:  # file is not actually compressed, just read decompressed bytes
+            with self.reader.view(data_loc, uncomp_length) as raw:
+                return bytes(raw)
+        with self.reader.view(data_loc, comp_length) as raw:
+            return decompress(raw, wbits=-15)
+
+    def _block_header(self, block: dict) -> tuple:
+        """Returns (data location, compressed length, uncompressed length) for a block."""
+        with self.reader.view(block["start_loc"], BLOCK_HEADER_SIZE) as header:
+            h_length, comp_length, uncomp_length = unpack_from("<I 4x I I", header)
+        return block["start_loc"] + BLOCK_HEADER_SIZE, comp_length, uncomp_length
+
+
+def _read_span(f: object, dat_file: str, start: int, length: int) -> DatSpan:
+    f.seek(start)
+    return DatSpan(dat_file=dat_file, start=start, data=f.read(length))
+
+
+def _entry_end(span: DatSpan, offset: int):
+    """
+    Returns where the entry at offset ends in the dat, or None if its block table
+    isn't entirely inside span.
+    """
+    if not span.contains(offset, BLOCK_TABLE_HEADER_SIZE):
+        return None
+    with span.view(offset, BLOCK_TABLE_HEADER_SIZE) as header:
+        length, num_blocks = unpack_from("<I 16x I", header)
+    if not span.contains(offset + BLOCK_TABLE_HEADER_SIZE, num_blocks * 8):
+        return None
+
+    end = offset + length
+    with span.view(offset + BLOCK_TABLE_HEADER_SIZE, num_blocks * 8) as block_data:
+        for block_offset, size, decomp_size in iter_unpack("<I H H", block_data):
+            end = max(end, offset + length + block_offset + size)
+    return end
+
+
+def _read_sorted(dat_file: str, items: list, read_ahead: int):
+    """Yields (index, DatEntry) for (offset, index) items that are sorted by offset."""
+    offsets = [offset for offset, index in items]
+    span = None
+    with open(dat_file, "rb") as f:
+        for i, (offset, index) in enumerate(items):
+            end = _entry_end(span, offset) if span else None
+            if end is None or end > span.end:
+                # read up to the start of the last requested entry that's within read_ahead
+                # (plus a bit for that entry itself), stopping at the first big gap so sparse
+                # entries don't pull in the unrequested data between them. never more than
+                # read_ahead, though.
+                stop = bisect_right(offsets, offset + read_ahead, lo=i)
+                j = i
+                while j + 1 < stop and offsets[j + 1] - offsets[j] <= MAX_READ_GAP:
+                    j += 1
+                last = offsets[j]
+                length = max(last - offset + MIN_READ_SIZE, (end or 0) - offset, BLOCK_TABLE_HEADER_SIZE)
+                span = _read_span(f, dat_file, offset, min(length, read_ahead))
+                end = _entry_end(span, offset)
+                if end is not None and end > span.end and end - offset <= read_ahead:
+                    # the guess was too small, but the entry still fits in a read_ahead sized read
+                    span = _read_span(f, dat_file, offset, end - offset)
+            if end is None or end > span.end:
+                # bigger than read_ahead. read it straight from the map instead of buffering it all.
+                yield index, DEFAULT_POOL.entry(dat_file, offset)
+                continue
+            yield index, DatEntry(dat_file=dat_file, offset=offset, reader=span)
+
+
+def read_entries(entries, order: str = "input", read_ahead: int = READ_AHEAD_SIZE):
+    """
+    Reads a batch of entries with large sequential reads instead of a seek per entry.
+
+    Entries are grouped by dat file and sorted by offset. The dat is then read in
+    chunks of at most read_ahead bytes, and every entry that falls inside a chunk is
+    served from memory. Much faster than following idx order (which is hash order, so
+    effectively random) on HDDs and network drives. Entries that don't fit in a chunk
+    are read from the dat's map (see DatPool) instead, so a chunk never holds more
+    than read_ahead bytes.
+
+    Every entry passed in is read, so only pass the ones that are going to be
+    decompressed. Anything that only needs the block table or the first few bytes
+    (sizes, checksums, types) is cheaper to get from the map with DatEntry.
+
+    :param entries: Iterable of (dat_file, offset) pairs.
+    :param order: "input" yields entries in the order they were given, "disk" yields them
+        in (dat file, offset) order as soon as they're read. "input" has to hold on to any
+        entries that are read before the ones in front of them, so prefer "disk" when the
+        order doesn't matter.
+    :param read_ahead: Largest read to make at once, in bytes.
+    :returns: Generator of (index into entries, DatEntry) tuples. The entries read from the
+        chunk they were found in, which is kept in memory for as long as the entry is.
+    """
+    if order not in ("input", "disk"):
+        raise ValueError(f"order must be \"input\" or \"disk\", not \"{order}\".")
+
+    by_dat = {}
+    for index, (dat_file, offset) in enumerate(entries):
+        by_dat.setdefault(dat_file, []).append((offset, index))
+
+    if order == "disk":
+        for dat_file in sorted(by_dat):
+            yield from _read_sorted(dat_file, sorted(by_dat[dat_file]), read_ahead)
+        return
+
+    pending = {}
+    next_index = 0
+    for dat_file in sorted(by_dat):
+        for index, entry in _read_sorted(dat_file, sorted(by_dat[dat_file]), read_ahead):
+            pending[index] = entry
+            while next_index in pending:
+                yield next_index, pending.pop(next_index)
+                next_index += 1
@@ -0,0 +1,254 @@
+import os
+from array import array
+from struct import calcsize, iter_unpack, unpack_from
+
+# every ETP has a 96 byte header (EVTX + BLJA + the INDX section header) before the INDX contents
+HEADER_SIZE = 96
+
+# FOOT (TOOF) + TEXT (TXET) section headers between the INDX contents and the strings
+TEXT_HEADER_SIZE = 32
+
+# the TEXT section of an ETP is a run of null-terminated UTF-8 strings. v0, v2 and BE
+# files point at them by byte offset; v1 and v4 point at them in 2 byte (UTF-16) units.
+BYTE_UNIT = 1
+UTF16_UNIT = 2
+
+
+def unpack_array(fmt: str, buf: bytes) -> array:
+    """Unpacks a table of a single struct type (ex: "<H") into a compact array of uints."""
+    return array("I", [value for value, in iter_unpack(fmt, buf)])
+
+
+class TextSection:
+    """
+    Decodes strings out of an ETP's TEXT section. The section is held as a single
+    bytes object, so looking up a string is one bytes.index for the terminator instead
+    of reading a byte at a time. Strings are cached by offset, since several ids often
+    point at the same string.
+    """
+    def __init__(self, data: bytes, unit: int = BYTE_UNIT):
+        """
+        :param data: The TEXT section body, from its first string onward. Anything after
+            the last string (ex: the FOOT sections) is fine to leave on the end.
+        :param unit: What offsets count in. BYTE_UNIT for v0/v2/BE, UTF16_UNIT for v1/v4.
+        """
+        self.data = bytes(data)
+        self.unit = unit
+        self.strings = {}
+
+    def __getitem__(self, offset: int) -> str:
+        text = self.strings.get(offset)
+        if text is None:
+            start = offset * self.unit
+            try:
+                end = self.data.index(b"\x00", start)
+            except ValueError:
+                raise ValueError(f"String at offset {offset} is not null-terminated.") from None
+            text = self.data[start:end].decode(encoding="utf-8")
+            self.strings[offset] = text
+        return text
+
+
+class EtpFile:
+    """
+    An ETP, parsed once into flat arrays that both unpack_etp and pack_etp work from:
+
+    - string_ids: every string id in INDX order (None for v1, which has no ids and keys strings by offset)
+    - offsets: the TEXT offset for every entry, in the same order
+    - text: the TEXT section (a TextSection), only decoded when it's first used
+
+    Supports v0, v1, v2, v4 and big-endian (BE) files.
+    """
+    def __init__(self, file, data=None):
+        """
+        :param file: Path to the ETP, or its contents as a bytes-like object.
+            A path is read in full once; nothing is read from it again after this.
+        :param data: Contents of the ETP, if they're already in memory (ex: a member of an RPS or
+            a dump_dat pack). When passed, file is only used as the ETP's name.
+        """
+        if data is None and not isinstance(file, (str, os.PathLike)):
+            data, file = file, ""
+        file = os.fspath(file)
+        self.file = file
+
+        if data is None:
+            with open(file, "rb") as f:
+                data = f.read()
+        self.data = bytes(data)
+
+        magic = self.data[0:4]
+        if magic not in (b"EVTX", b"XTVE"):
+            raise ValueError("Not an ETP file.")
+        if len(self.data) < HEADER_SIZE:
+            raise ValueError(f"File is too short to be an ETP ({len(self.data)} bytes).")
+        if magic == b"XTVE":
+            self.version = "be"
+            self.byte_order = ">"
+        else:
+            self.version = self.data[15]
+            self.byte_order = "<"
+
+        parsers = {
+            0: self._parse_event_text,
+            2: self._parse_event_text,
+            1: self._parse_sub_package,
+            "be": self._parse_event_text,
+            4: self._parse_smldt_msg_pkg,
+        }
+        parser = parsers.get(self.version)
+        if parser is None:
+            raise ValueError(f"ETP version \"{self.version}\" is not currently supported.")
+
+        self.header = self.data[0:HEADER_SIZE]
+        indx_size = unpack_from(self.byte_order + "I", self.data, 88)[0]
+        self.indx = self.data[HEADER_SIZE:HEADER_SIZE+indx_size]
+        self.text_start = HEADER_SIZE + indx_size + TEXT_HEADER_SIZE
+        if self.text_start > len(self.data):
+            raise ValueError(f"ETP is truncated: its TEXT section starts at {self.text_start}, "
+                             f"but the file is {len(self.data)} bytes.")
+        self.unit = UTF16_UNIT if self.version in (1, 4) else BYTE_UNIT
+        self.string_ids = None
+        self.short_count = 0
+        self._text = None
+        parser()
+
+    def _indx_table(self, fmt: str, start: int, count: int) -> array:
+        """
+        Unpacks count values of fmt (ex: "<H") from the INDX contents, starting at start.
+        Raises ValueError if the INDX contents end before the table does.
+        """
+        end = start + calcsize(fmt) * count
+        if count < 0 or end > len(self.indx):
+            raise ValueError(f"INDX table at {start} with {count} entries runs past the end of "
+                             f"the INDX contents ({len(self.indx)} bytes).")
+        return unpack_array(fmt, self.indx[start:end])
+
+    def _parse_event_text(self):
+        # v0/v2 and BE file layout (BE is the same with every value big-endian, and
+        # XTVE/ALJB/XDNI/TOOF/TXET for the section names):
+        #   0x00 ( 4 bytes): "EVTX" magic
+        #   0x50 (80, 4 bytes): "INDX" section signature
+        #   0x54 (84, 4 bytes): INDX header length
+        #   0x58 (88, 4 bytes): INDX contents size (bytes)
+        #   0x5C (92, 4 bytes): padding
+        #   0x60 (96, N bytes): INDX contents — pairs of (string_id: uint32, offset: uint32)
+        #   0x60+N (16 bytes): FOOT section
+        #   0x60+N+16 (16 bytes): TEXT section header
+        #   0x60+N+32 onward: null-terminated strings (TEXT section body)
+        #
+        # Each INDX entry maps a string_id to a byte offset into the TEXT body.
+        # string_id == 0 is a placeholder/empty entry.
+        pairs = unpack_array(self.byte_order + "I", self.indx)
+        self.string_ids = pairs[0::2]
+        self.offsets = pairs[1::2]
+
+    def _parse_sub_package(self):
+        # LE ETP v1 file layout:
+        #   0x00 ( 4 bytes): "EVTX" magic
+        #   0x2C (44, 4 bytes): total offset count (from CMNH section header)
+        #   0x58 (88, 4 bytes): INDX contents size (bytes)
+        #   0x5C (92, 4 bytes): padding
+        #   0x60 (96, N bytes): INDX contents
+        #     +0x00 (2 bytes): unknown
+        #     +0x02 (2 bytes): count of entries in the short (2-byte) offset table
+        #     +0x04 (16 bytes): unknown
+        #     +0x14 (20, variable): short offset table — short_count * uint16 offsets
+        #     after short table: optional 2-byte alignment pad (if file pos is not 4-byte aligned)
+        #     after alignment: long offset table — (offset_count - short_count) * uint32 offsets
+        #   0x60+N (16 bytes): FOOT section
+        #   0x60+N+16 (16 bytes): TEXT section header
+        #   0x60+N+32 onward: null-terminated strings (TEXT section body)
+        #
+        # Each offset is a character index into the TEXT body (UTF16_UNIT, 2 bytes per unit).
+        # There are no string ids; offset == 0 is an empty entry.
+        # Offsets exceeding ushort range overflow into the long (4-byte uint) table.
+        offset_count = unpack_from("<I", self.data, 44)[0]
+        self.short_count = unpack_from("<H", self.indx, 2)[0]
+        short_table_end = 20 + self.short_count * 2
+        self.offsets = self._indx_table("<H", 20, self.short_count)
+
+        # Two padding bytes ("CD AB") may precede the long table to restore 4-byte alignment.
+        long_table_start = short_table_end
+        if (long_table_start + HEADER_SIZE) % 4 != 0:
+            long_table_start += 2
+        long_count = offset_count - self.short_count
+        self.offsets += self._indx_table("<I", long_table_start, long_count)
+
+    def _parse_smldt_msg_pkg(self):
+        # ETP v4 file layout:
+        #   0x00 ( 4 bytes): "EVTX" magic
+        #   0x58 (88, 4 bytes): INDX table size (bytes)
+        #   0x5C (92, 4 bytes): padding
+        #   0x60 (96, N bytes): INDX table
+        #     +0x00 (2 bytes): count of 2-byte string IDs
+        #     +0x02 (2 bytes): count of entries in the short (2-byte) offset table
+        #     +0x04 (4 bytes): unknown
+        #     +0x08 (4 bytes): offset within INDX table where 4-byte string ID section begins
+        #     +0x0C (4 bytes): offset within INDX table where short (2-byte) offset table begins
+        #     +0x10 (4 bytes): offset within INDX table where long (4-byte) offset table begins
+        #     +0x14 (20, variable): 2-byte string IDs
+        #     at long_str_start: 4-byte string IDs (empty when all IDs fit in a ushort)
+        #     at short_offset_start: short (2-byte) offset table
+        #     at long_offset_start: long (4-byte) offset table (remainder of INDX table)
+        #   0x60+N (32 bytes): FOOT section (16 bytes) + TEXT section header (16 bytes)
+        #   0x60+N+32 onward: null-terminated strings (TEXT section body)
+        #
+        # String IDs and their offsets are stored in parallel: 2-byte IDs pair with 2-byte offsets,
+        # 4-byte IDs pair with 4-byte offsets. Each offset is a character index into the TEXT body
+        # (UTF16_UNIT, 2 bytes per unit). Several IDs may share an offset.
+        short_id_count, self.short_count, _, long_str_start, short_off_start, long_off_start = unpack_from(
+            "<H H I I I I", self.indx, 0
+        )
+        self.short_id_table = self.indx[20:20 + short_id_count * 2]
+        self.long_id_table = self.indx[long_str_start:short_off_start]
+
+        if len(self.short_id_table) != short_id_count * 2 or short_off_start > len(self.indx):
+            raise ValueError(f"INDX string id tables run past the end of the INDX contents ({len(self.indx)} bytes).")
+
+        self.string_ids = unpack_array("<H", self.short_id_table) + unpack_array("<I", self.long_id_table)
+
+        long_count = len(self.string_ids) - self.short_count
+        self.offsets = self._indx_table("<H", short_off_start, self.short_count)
+        self.offsets += self._indx_table("<I", long_off_start, long_count)
+
+    @property
+    def text(self) -> TextSection:
+        if self._text is None:
+            self._text = TextSection(self.data[self.text_start:], unit=self.unit)
+        return self._text
+
+    def strings(self):
+        """
+        Yields a (key, string) tuple for every string in the file, keyed the same way
+        unpack_etp's JSONs are: by string id, except for v1 which is keyed by offset.
+
+        Empty entries (id 0 for v0/v2/BE, offset 0 for v1) are skipped. For v1 and v4,
+        only the first entry pointing at an offset is yielded; pack_etp points the
+        rest back at it.
+        """
+        if self.version == 1:
+            keys = self.offsets
+        else:
+            keys = self.string_ids
+
+        offsets_seen = set()
+        for key, offset in zip(keys, self.offsets):
+            if key == 0 and self.version != 4:
+                continue
+            if self.version in (1, 4):
+                # game will sometimes have string ids that are pointing to the same
+                # offset. in this case, we only want to use the first occurrence.
+                if offset in offsets_seen:
+                    continue
+                offsets_seen.add(offset)
+            yield key, self.text[offset]
+
+    def duplicates(self) -> list:
+        """
+        Groups string ids that point at the same offset, in the order each offset is
+        first seen. Every id is in exactly one group; most groups have a single id.
+        """
+        groups = {}
+        for string_id, offset in zip(self.string_ids, self.offsets):
+            groups.setdefault(offset, []).append(string_id)
+        return list(groups.values())
@@ -1,31 +1,103 @@
 # a lot of these are probably not their true extension, but helps
 # identify what type of file it is based on the file's header.
-EXTENSIONS = {
-    b"\x45\x56\x54\x58\x10\x00\x00": ".etp",  # dialog files
-    b"\x53\x45\x44\x42\x6C\x79\x62": ".sedblyb",
-    b"\x61\x73\x74\x62\x01\x00\x00": ".astb",
-    b"\x61\x73\x74\x62\x02\x00\x00": ".astb",
-    b"\x61\x73\x74\x62\x03\x00\x00": ".astb",
-    b"\x61\x73\x74\x62\x04\x00\x00": ".astb",
-    b"\x53\x45\x44\x42\x52\x45\x53": ".rps",  # SEDBRES
-    b"\x89\x50\x4E\x47\x51\x01\x01": ".png_inval",  # real png, but they all appear to be encrypted
-    b"\x6D\x64\x6C\x62\x01\x00\x00": ".mdlb",
-    b"\x6D\x64\x6C\x62\x02\x00\x00": ".mdlb",
-    b"\x64\x65\x66\x62\x03\x00\x00": ".defb",
-    b"\x64\x65\x66\x62\x02\x00\x00": ".defb",
-    b"\x44\x44\x53\x20\x7C\x00\x00": ".dds",
-    b"\x3C\x3F\x78\x6D\x6C\x20\x76": ".xml",
-    b"\xEF\xBB\xBF\x3C\x3F\x78\x6D": ".xml",
-    b"\x45\x46\x58\x30\x30\x31\x31": ".efx",
-    b"\x53\x45\x44\x42\x74\x78\x62": ".sedbtxb",
-    b"\x63\x6C\x74\x00\x01\x00\x00": ".clt",
-    b"\x23\x66\x69\x6C\x65\x53\x65": ".fileset",
-    b"\x47\x72\x6F\x75\x70\x2C\x31": ".group",
-    b"\x53\x45\x44\x42\x44\x53\x42": ".sedbdsb",
-    b"\x53\x45\x44\x42\x53\x43\x42": ".sedbscb",
-    b"\x53\x45\x44\x42\x53\x53\x43": ".scd",  # SEDBSSCF files, which are audio. can play them in vgmstream
-    b"\x32\x30\x31\x30\x30\x31\x31": ".20100114",  # not sure what this is
-    b"\x3C\x52\x70\x73\x50\x72\x6F": ".xml",  # this is an <RpsProject> file, but it's an xml
-    b"\x43\x52\x59\x09":             ".cry",  # CRY file, which is encrypted.
-    b"\x4D\x4C\x42\x44\x02\x00\x00": ".mlbd"
+#
+# (signature, extension, sub-version). signatures can be any length; when more than one
+# matches a header, the longest one wins. sub-version is the version of the format the
+# signature implies (ex: astb\x02 is astb v2), or None if it doesn't say.
+SIGNATURES = [
+    (b"\x45\x56\x54\x58\x10\x00\x00", ".etp", None),  # dialog files. version is at byte 15, see VERSION_OFFSETS
+    (b"\x58\x54\x56\x45",             ".etp", "be"),  # XTVE, big endian dialog files
+    (b"\x53\x45\x44\x42\x6C\x79\x62", ".sedblyb", None),
+    (b"\x61\x73\x74\x62\x01\x00\x00", ".astb", 1),
+    (b"\x61\x73\x74\x62\x02\x00\x00", ".astb", 2),
+    (b"\x61\x73\x74\x62\x03\x00\x00", ".astb", 3),
+    (b"\x61\x73\x74\x62\x04\x00\x00", ".astb", 4),
+    (b"\x53\x45\x44\x42\x52\x45\x53", ".rps", None),  # SEDBRES
+    (b"\x89\x50\x4E\x47\x51\x01\x01", ".png_inval", None),  # real png, but they all appear to be encrypted
+    (b"\x6D\x64\x6C\x62\x01\x00\x00", ".mdlb", 1),
+    (b"\x6D\x64\x6C\x62\x02\x00\x00", ".mdlb", 2),
+    (b"\x64\x65\x66\x62\x03\x00\x00", ".defb", 3),
+    (b"\x64\x65\x66\x62\x02\x00\x00", ".defb", 2),
+    (b"\x44\x44\x53\x20\x7C\x00\x00", ".dds", None),
+    (b"\x3C\x3F\x78\x6D\x6C\x20\x76", ".xml", None),
+    (b"\xEF\xBB\xBF\x3C\x3F\x78\x6D", ".xml", None),
+    (b"\x45\x46\x58\x30\x30\x31\x31", ".efx", None),
+    (b"\x53\x45\x44\x42\x74\x78\x62", ".sedbtxb", None),
+    (b"\x63\x6C\x74\x00\x01\x00\x00", ".clt", 1),
+    (b"\x23\x66\x69\x6C\x65\x53\x65", ".fileset", None),
+    (b"\x47\x72\x6F\x75\x70\x2C\x31", ".group", None),
+    (b"\x53\x45\x44\x42\x44\x53\x42", ".sedbdsb", None),
+    (b"\x53\x45\x44\x42\x53\x43\x42", ".sedbscb", None),
+    (b"\x53\x45\x44\x42\x53\x53\x43", ".scd", None),  # SEDBSSCF files, which are audio. can play them in vgmstream
+    (b"\x32\x30\x31\x30\x30\x31\x31", ".20100114", None),  # not sure what this is
+    (b"\x3C\x52\x70\x73\x50\x72\x6F", ".xml", None),  # this is an <RpsProject> file, but it's an xml
+    (b"\x43\x52\x59\x09",             ".cry", None),  # CRY file, which is encrypted.
+    (b"\x4D\x4C\x42\x44\x02\x00\x00", ".mlbd", 2),
+]
+
+# formats that keep their version somewhere after the signature: extension -> offset of the version byte
+VERSION_OFFSETS = {
+    ".etp": 15,
 }
+
+# signature -> extension. kept for anything that still wants a plain dict lookup.
+EXTENSIONS = {signature: ext for signature, ext, _ in SIGNATURES}
+
+
+class Classifier:
+    """
+    Figures out a file's type from its first few bytes.
+
+    Signatures are bucketed by their first byte and each bucket is sorted longest first,
+    so a header is only compared against the handful of signatures that start with the
+    same byte, and the first match is the longest one.
+    """
+    def __init__(self, signatures: list, version_offsets: dict = None):
+        self.version_offsets = version_offsets or {}
+        self.table = {}
+        for signature in signatures:
+            self.table.setdefault(signature[0][0], []).append(signature)
+        for bucket in self.table.values():
+            bucket.sort(key=lambda signature: len(signature[0]), reverse=True)
+
+        # how many bytes of a file classify() needs to see
+        self.header_size = max(
+            [len(signature) for signature, _, _ in signatures] +
+            [offset + 1 for offset in self.version_offsets.values()]
+        )
+
+    def classify(self, header: bytes) -> tuple:
+        """
+        Returns an (extension, sub-version) tuple for a header, or ("", None) if nothing
+        matches. Pass at least header_size bytes to get sub-versions that aren't part of
+        the signature; shorter headers still get the extension.
+        """
+        header = bytes(header[0:self.header_size])
+        if not header:
+            return "", None
+        for signature, ext, version in self.table.get(header[0], ()):
+            if header.startswith(signature):
+                offset = self.version_offsets.get(ext)
+                if version is None and offset is not None and len(header) > offset:
+                    version = header[offset]
+                return ext, version
+        return "", None
+
+    def extension(self, header: bytes) -> str:
+        """Returns just the extension for a header, or an empty string if it isn't known."""
+        return self.classify(header)[0]
+
+
+# shared by everything that needs to name or sort files by type
+CLASSIFIER = Classifier(SIGNATURES, VERSION_OFFSETS)
+HEADER_SIZE = CLASSIFIER.header_size
+
+
+def classify(header: bytes) -> tuple:
+    """Returns an (extension, sub-version) tuple for a header. See Classifier.classify."""
+    return CLASSIFIER.classify(header)
+
+
+def get_extension(header: bytes) -> str:
+    """Returns the extension for a header, or an empty string if it isn't known."""
+    return CLASSIFIER.extension(header)
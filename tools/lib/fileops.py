@@ -36,13 +36,3 @@ def write_toof(file_obj: object):
 def write_txet(file_obj: object):
     """Write big-endian TEXT section header (TXET)."""
     return file_obj.write(b"\x54\x58\x45\x54\x00\x00\x00\x10\x00\x00\x00\x00\x00\x00\x00\x00")
-
-
-def read_cstr(f: object) -> str:
-    buf = bytearray()
-    while True:
-        char = f.read(1)
-        if char != b"\x00":
-            buf.extend(char)
-        else:
-            return buf.decode(encoding="utf-8")
@@ -1,8 +1,13 @@
+from array import array
 from binascii import hexlify
-from struct import unpack, pack
+import mmap
+import sys
+from struct import iter_unpack, unpack, pack
 
 SMPK_SIZE = 0x400
 STRUCT_SIZE = 0x400
+RECORD_SIZE = 0x10
+SMPK_FORMAT = "<4s 8x I 4x I 936x 20s 44x"
 
 file_types = {
     1: "SQDB?",
@@ -11,24 +16,194 @@ file_types = {
 }
 
 
+def get_dat_offset(dat_loc: int) -> int:
+    """Returns the byte offset into the dat file from a packed idx dat location."""
+    return (dat_loc & ~0xF) * 0x08
+
+
+def get_dat_num(dat_loc: int) -> int:
+    """Returns the dat number (the N in .datN) from a packed idx dat location."""
+    return (dat_loc & 0b1110) >> 1
+
+
+def get_filename(file_hash: int, folder_hash: int) -> str:
+    """
+    Returns the 16 character hex name used throughout the tools to identify a record.
+    This is the first 8 bytes of the index entry as they appear on disk.
+    """
+    return pack("<I I", file_hash, folder_hash).hex()
+
+
+def get_hashes(filename: str) -> tuple:
+    """
+    Reverse of get_filename. Returns the (file_hash, folder_hash) pair
+    for a 16 character hex name.
+    """
+    if len(filename) != 16:
+        raise ValueError(f"{filename} is not a 16 character file + folder hash.")
+    return unpack("<I I", bytes.fromhex(filename))
+
+
+class IdxRecords:
+    """
+    Column store of the idx file's records segment.
+
+    Each 16 byte row is split into three arrays (file_hashes, folder_hashes and
+    dat_locs, the packed dat number + offset). The dict records the tools have always
+    worked with are only built when one is asked for, so opening an idx file costs a
+    couple of array copies instead of a dict per row.
+
+    Indexing with "count" or "records" keeps the old dict layout working:
+    records["count"] is the number of rows and records["records"] is this object.
+    """
+    def __init__(self, buf):
+        rows = array("I")
+        rows.frombytes(buf)
+        if sys.byteorder == "big":
+            rows.byteswap()
+
+        self.file_hashes = rows[0::4]
+        self.folder_hashes = rows[1::4]
+        self.dat_locs = rows[2::4]
+        self.count = len(self.file_hashes)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self.record(i)
+
+    def __getitem__(self, key):
+        if key == "count":
+            return self.count
+        if key == "records":
+            return self
+        if isinstance(key, slice):
+            return [self.record(i) for i in range(*key.indices(self.count))]
+        if key < 0:
+            key += self.count
+        if not 0 <= key < self.count:
+            raise IndexError("record index out of range")
+        return self.record(key)
+
+    def record(self, i: int) -> dict:
+        """Builds the dict for row i."""
+        file_hash = self.file_hashes[i]
+        folder_hash = self.folder_hashes[i]
+        dat_loc = self.dat_locs[i]
+
+        # using as an identifier to figure out which row in the index something is in
+        # since I don't have filenames to work with. this just outputs the first 8 bytes
+        # of the index entry.
+        return {
+            "file_hash": file_hash,
+            "folder_hash": folder_hash,
+            "idx_offset": SMPK_SIZE + STRUCT_SIZE + i * RECORD_SIZE,
+            "dat_offset": get_dat_offset(dat_loc),
+            "dat_num": str(get_dat_num(dat_loc)),
+            "filename": get_filename(file_hash, folder_hash)
+        }
+
+
 class IdxFile:
     def __init__(self, file: str):
         self.file = file
 
-        # idx files are pretty small (less than 4MB), so read all in
-        with open(file, "rb") as f:
-            file_data = f.read()
+        # map the file instead of reading it in. the records segment is copied
+        # straight into the column arrays, so the map can be closed afterwards
+        # (keeping it open would hold a lock on the idx on Windows).
+        with open(file, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as file_map:
+            with memoryview(file_map) as file_data:
+                self.smpk = self.smpk(
+                    buf=file_data[0:SMPK_SIZE])
+                self.segments = self.segments(
+                    buf=file_data[SMPK_SIZE:SMPK_SIZE+STRUCT_SIZE])
+                self.records = self.records(
+                    buf=file_data[SMPK_SIZE+STRUCT_SIZE:SMPK_SIZE+STRUCT_SIZE+self.segments[1]["size"]]
+                )
+                self.folders = self.folders(
+                    buf=file_data[self.segments[4]["offset"]:self.segments[4]["offset"]+self.segments[4]["size"]]
+                )
+
+        self._hash_index = None
+        self._folder_index = None
+
+    @property
+    def hash_index(self) -> dict:
+        """
+        Maps (file_hash << 32 | folder_hash) to the record's row number.
+        Built on first use; the first row wins if a hash pair shows up more than once.
+        """
+        if self._hash_index is None:
+            file_hashes = self.records.file_hashes
+            folder_hashes = self.records.folder_hashes
+            self._hash_index = {
+                (file_hashes[i] << 32) | folder_hashes[i]: i
+                for i in range(self.records.count - 1, -1, -1)
+            }
+        return self._hash_index
+
+    def lookup(self, file_hash: int, folder_hash: int):
+        """Returns the record for the file + folder hash pair, or None if this idx doesn't have it."""
+        row = self.hash_index.get((file_hash << 32) | folder_hash)
+        if row is None:
+            return None
+        return self.records.record(row)
+
+    def contains(self, file_hash: int, folder_hash: int) -> bool:
+        return ((file_hash << 32) | folder_hash) in self.hash_index
 
-        self.smpk = self.smpk(
-            buf=file_data[0:SMPK_SIZE])
-        self.segments = self.segments(
-            buf=file_data[SMPK_SIZE:SMPK_SIZE+STRUCT_SIZE])
-        self.records = self.records(
-            buf=file_data[SMPK_SIZE+STRUCT_SIZE:SMPK_SIZE+STRUCT_SIZE+self.segments[1]["size"]]
-        )
+    def lookup_name(self, filename: str):
+        """Same as lookup, but takes the 16 character hex name (ex: dd2d262c3b39fbd1)."""
+        return self.lookup(*get_hashes(filename))
+
+    @property
+    def folder_index(self) -> dict:
+        """
+        Maps folder_hash to the row numbers of every record in that folder.
+
+        Records are sorted by folder, so the folder segment gives each folder as a
+        contiguous run of rows and the values are ranges. If the folder segment doesn't
+        line up with the records, the rows are grouped by hand instead (array values).
+        """
+        if self._folder_index is None:
+            folder_hashes = self.records.folder_hashes
+            index = {}
+            for folder_hash, folder in self.folders.items():
+                first = folder["first_record"]
+                last = first + folder["num_records"] - 1
+                if (
+                    first < 0
+                    or folder["num_records"] == 0
+                    or last >= self.records.count
+                    or folder_hashes[first] != folder_hash
+                    or folder_hashes[last] != folder_hash
+                ):
+                    index = None
+                    break
+                index[folder_hash] = range(first, last + 1)
+
+            if not index or sum(len(rows) for rows in index.values()) != self.records.count:
+                index = {}
+                for i, folder_hash in enumerate(folder_hashes):
+                    if folder_hash not in index:
+                        index[folder_hash] = array("I")
+                    index[folder_hash].append(i)
+
+            self._folder_index = index
+        return self._folder_index
+
+    def folder_rows(self, folder_hash: int):
+        """Returns the row numbers of every record in a folder (empty if the idx doesn't have the folder)."""
+        return self.folder_index.get(folder_hash, range(0))
+
+    def folder_records(self, folder_hash: int) -> list:
+        """Returns the records of every file in a folder."""
+        return [self.records.record(i) for i in self.folder_rows(folder_hash)]
 
     def smpk(self, buf):
-        data = unpack("<4s 8x I 4x I 936x 20s 44x", buf)
+        data = unpack(SMPK_FORMAT, buf)
         header = {
             "signature": data[0],
             "length": data[1],
@@ -72,36 +247,17 @@ class IdxFile:
         return segments
 
     def records(self, buf):
-        rows = buf
-        count = 0
-        position = 0
-        records = []
-        num_records = len(rows) / 16
-
-        record_dict = {
-            "count": int(num_records),
-            "records": records
-        }
+        return IdxRecords(buf)
 
-        while count < num_records:
-            data = unpack("<I I I 4x", rows[position:position+16])
-
-            # using as an identifier to figure out which row in the index something is in
-            # since I don't have filenames to work with. this just outputs the first 8 bytes
-            # of the index entry.
-            filename = (hexlify(pack("<L", data[0])) + hexlify(pack("<L", data[1]))).decode()
-
-            record = {
-                "file_hash": data[0],
-                "folder_hash": data[1],
-                "idx_offset": SMPK_SIZE + STRUCT_SIZE + position,
-                "dat_offset": (data[2] & ~0xF) * 0x08,
-                "dat_num": str((data[2] & 0b1110) >> 1),
-                "filename": filename
+    def folders(self, buf):
+        folders = {}
+        for folder_hash, files_offset, files_size in iter_unpack("<I I I 4x", buf):
+            folders[folder_hash] = {
+                "folder_hash": folder_hash,
+                "files_offset": files_offset,  # absolute offset in the idx of the folder's first record
+                "files_size": files_size,
+                "first_record": (files_offset - SMPK_SIZE - STRUCT_SIZE) // RECORD_SIZE,
+                "num_records": files_size // RECORD_SIZE
             }
 
-            records.append(record)
-            count += 1
-            position += 16
-
-        return record_dict
+        return folders
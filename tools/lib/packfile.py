@@ -0,0 +1,141 @@
+import io
+import mmap
+from struct import calcsize, pack, unpack_from
+
+PACK_MAGIC = b"DQXPACK\x00"
+
+# each index entry: data offset, data length, name length, then the utf-8 name
+INDEX_ENTRY_FORMAT = "<Q Q H"
+INDEX_ENTRY_SIZE = calcsize(INDEX_ENTRY_FORMAT)
+
+# last bytes of the file: index offset, number of members, magic
+FOOTER_FORMAT = "<Q I 4x 8s"
+FOOTER_SIZE = calcsize(FOOTER_FORMAT)
+
+
+class PackWriter:
+    """
+    Writes a pack file: every member's data back to back from the start of the file,
+    followed by an index of (offset, length, name) and a fixed size footer pointing
+    at the index. Members are written strictly in order, so the whole file is one
+    sequential write.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, "wb")
+        self.file.write(PACK_MAGIC)
+        self.index = []
+        self.members = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, name: str, chunks) -> int:
+        """
+        Adds a member.
+
+        :param name: Name of the member, "/" separated (ex: data00000000.win32.dat0/dd2d262c3b39fbd1.etp).
+        :param chunks: Iterable of bytes-like objects that make up the member's data.
+        :returns: Number of bytes written.
+        """
+        offset = self.file.tell()
+        for chunk in chunks:
+            self.file.write(chunk)
+        length = self.file.tell() - offset
+        self.index.append((offset, length, name))
+        self.members[name] = (offset, length)
+        return length
+
+    def alias(self, name: str, target: str) -> int:
+        """
+        Adds a member that points at the data of an already written member, so
+        identical files are only stored once.
+
+        :returns: Size of the aliased data.
+        """
+        offset, length = self.members[target]
+        self.index.append((offset, length, name))
+        self.members[name] = (offset, length)
+        return length
+
+    def discard_last(self):
+        """Removes the last written member and truncates its data off the end of the pack."""
+        offset, length, name = self.index.pop()
+        del self.members[name]
+        self.file.seek(offset)
+        self.file.truncate()
+
+    def close(self):
+        if self.file.closed:
+            return
+        index_offset = self.file.tell()
+        for offset, length, name in self.index:
+            encoded = name.encode("utf-8")
+            self.file.write(pack(INDEX_ENTRY_FORMAT, offset, length, len(encoded)))
+            self.file.write(encoded)
+        self.file.write(pack(FOOTER_FORMAT, index_offset, len(self.index), PACK_MAGIC))
+        self.file.close()
+
+
+class PackFile:
+    """
+    Reads a pack file written by PackWriter (ex: a dump_dat -o out.pack dump).
+    Members are memoryview slices of a mmap of the pack, so nothing is extracted to disk.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self.map) < len(PACK_MAGIC) + FOOTER_SIZE or self.map[0:len(PACK_MAGIC)] != PACK_MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a pack file.")
+
+        index_offset, count, magic = unpack_from(FOOTER_FORMAT, self.map, len(self.map) - FOOTER_SIZE)
+        if magic != PACK_MAGIC:
+            self.close()
+            raise ValueError(f"{path} is missing its index. Was the dump interrupted?")
+
+        self.members = {}
+        pos = index_offset
+        for _ in range(count):
+            offset, length, name_length = unpack_from(INDEX_ENTRY_FORMAT, self.map, pos)
+            pos += INDEX_ENTRY_SIZE
+            name = self.map[pos:pos+name_length].decode("utf-8")
+            pos += name_length
+            self.members[name] = (offset, length)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.members
+
+    def __len__(self):
+        return len(self.members)
+
+    def names(self, suffix: str = "") -> list:
+        """Returns the names of every member, optionally only the ones ending in suffix (ex: ".etp")."""
+        return [name for name in self.members if name.endswith(suffix)]
+
+    def read(self, name: str) -> memoryview:
+        """
+        Returns a member's data without copying it. Release the view (or let it go out
+        of scope) before closing the pack.
+        """
+        offset, length = self.members[name]
+        return memoryview(self.map)[offset:offset+length]
+
+    def open(self, name: str) -> io.BytesIO:
+        """Returns a seekable file object over a copy of a member's data."""
+        offset, length = self.members[name]
+        return io.BytesIO(self.map[offset:offset+length])
+
+    def close(self):
+        self.map.close()
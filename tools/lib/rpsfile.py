@@ -1,20 +1,62 @@
+import io
+import mmap
 import os
-from struct import unpack
-from .extensions import EXTENSIONS
+from bisect import bisect_right
+from struct import iter_unpack, pack, pack_into, unpack_from
+from .extensions import get_extension
 
 HEADER_SIZE = 0x30
+INDEX_ENTRY_SIZE = 16
+
+# entries in the index table that describe the other entries instead of being files
+META_RESOURCES = ["RESOURCE_ID", "RESOURCE_TYPE"]
+
+# how much of the path table to look at at a time when splitting out names
+NAME_CHUNK_SIZE = 64 * 1024
+
+# files are padded out to the alignment with this byte
+PADDING_BYTE = b"\x99"
+
+
+def get_alignment(format_ver: int) -> int:
+    """Files in an RPS start on a multiple of this. It depends on the format version."""
+    if format_ver >= 4103:
+        return 64
+    if format_ver >= 4003:
+        return 32
+    return 1
 
 
 class RpsFile:
-    def __init__(self, file: str):
+    def __init__(self, file, data=None):
+        """
+        :param file: Path to the RPS file, or the contents of one (bytes, bytearray,
+            memoryview, mmap or anything else that supports the buffer protocol).
+            A path is also used to name the folder dump() writes to. Buffers don't
+            have one, so dump() and extract() need a dest for those.
+        :param data: Contents of the RPS file, if they're already in memory (ex: a member
+            of a dump_dat pack). When passed, file is only used as a name.
+        """
+        if data is None and not isinstance(file, (str, os.PathLike)):
+            data, file = file, ""
+        file = os.fspath(file)
         self.file = file
-        self.output_folder = file.rsplit("\\", 1)[0] + "\\" + file.split("\\")[-1].replace(".", "_")
-
-        with open(file, "rb") as f:
-            file_data = f.read()
+        self.output_folder = None
+        if file:
+            self.output_folder = file.rsplit("\\", 1)[0] + "\\" + file.split("\\")[-1].replace(".", "_")
+
+        # paths are mapped rather than read, so only the parts of the file
+        # that are actually used get paged in.
+        self._map = None
+        if data is None:
+            with open(file, "rb") as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            data = self._map
+        self.file_data = memoryview(data).cast("B")
+        file_data = self.file_data
 
         if file_data[0:8] != b"\x53\x45\x44\x42\x52\x45\x53\x20":  # SEDBRES
-            raise(f"{file} is not an RPS file!")
+            raise ValueError(f"{file or 'data'} is not an RPS file!")
 
         self.header = self.header(
             buf=file_data[0:HEADER_SIZE])
@@ -27,10 +69,32 @@ class RpsFile:
         self.resource_ids = self.resource_ids(
             buf=file_data)
         self.__add_resources_to_indx()
+        self._members = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """
+        Releases the file. Only needed when the RpsFile was opened from a path.
+        If member views (or an RpsWriter's pieces) are still alive, the map isn't closed
+        out from under them; it's unmapped once the last of those views is released.
+        """
+        self._members = None
+        self.file_data.release()
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                pass
+            self._map = None
 
     # this is a best effort guess, but the important stuff is here.
     def header(self, buf):
-        data = unpack("<8s I B B H I I I I I I I 4s", buf)
+        data = unpack_from("<8s I B B H I I I I I I I 4s", buf)
 
         header = {
             "magic": data[0].decode(),
@@ -52,14 +116,9 @@ class RpsFile:
 
         # Calculate the file_base_offset based on the alignment.
         # The alignment changes depending on the format version.
-        entry_table_start = 0x30  # fixed
-        entry_size = 16
-        if header["format_ver"] >= 4103:
-            alignment = 64
-        elif header["format_ver"] >= 4003:
-            alignment = 32
-        else:
-            alignment = 1
+        entry_table_start = HEADER_SIZE  # fixed
+        entry_size = INDEX_ENTRY_SIZE
+        alignment = get_alignment(header["format_ver"])
 
         file_base_offset = (entry_table_start + (entry_size*header["entry_count"]) + alignment - 1) & ~(alignment - 1)
         header.update({"file_base_offset": file_base_offset})
@@ -68,39 +127,44 @@ class RpsFile:
 
 
     def index_table(self, buf):
-        position = 0
-        rows = []
-
-        table = {
-            "rows": rows
-        }
-
-        for i in range(self.header["entry_count"]):
-            data = unpack("<I I I I", buf[position:position+16])
-            row = {
+        count = self.header["entry_count"]
+        rows = [
+            {
                 "count": data[0],
                 "offset": data[1],
                 "length": data[2],
                 "flags": data[3],
             }
+            for data in iter_unpack("<I I I I", buf[0:count * INDEX_ENTRY_SIZE])
+        ]
 
-            rows.append(row)
-            position += 16
+        table = {
+            "rows": rows
+        }
 
         return table
 
 
     def resource_names(self, buf):
+        """
+        The path table is every resource name back to back, null terminated. It's split a
+        chunk at a time so a name cut off at the end of a chunk is picked up by the next one.
+        """
         names = []
+        count = self.header["entry_count"]
         pos = self.header["file_base_offset"] + self.header["path_table_offset"]
-        for i in range(self.header["entry_count"]):
-            name = ""
-            while buf[pos:pos+1] != b"\x00":
-                name = name + buf[pos:pos+1].decode()
-                pos = pos + 1
-
-            pos += 1
-            names.append(name)
+        while len(names) < count:
+            chunk = bytes(buf[pos:pos+NAME_CHUNK_SIZE])
+            parts = chunk.split(b"\x00")
+            if len(parts) == 1:
+                if len(chunk) < NAME_CHUNK_SIZE:
+                    raise ValueError(f"Path table ends after {len(names)} of {count} names.")
+                raise ValueError(f"Name at {pos} is longer than {NAME_CHUNK_SIZE} bytes.")
+
+            # the last part either didn't end in a null or is the empty string after the last one
+            for part in parts[:-1][:count - len(names)]:
+                names.append(part.decode())
+                pos += len(part) + 1
 
         return names
 
@@ -109,26 +173,17 @@ class RpsFile:
         idx = self.resource_names.index("RESOURCE_TYPE")
         entry = self.index_table["rows"][idx]
         pos = self.header["file_base_offset"] + entry["offset"]
-        types = []
-        for i in range(self.header["entry_count"]):
-            res_type = buf[pos:pos+4].decode("ascii")[::-1].strip("\x00")
-            types.append(res_type)
-            pos += 4
-
-        return types
+        table = buf[pos:pos + self.header["entry_count"] * 4]
+        # stored backwards, ex: b"\x00pte" is "etp"
+        return [res_type[::-1].strip(b"\x00").decode("ascii") for res_type, in iter_unpack("4s", table)]
 
 
     def resource_ids(self, buf):
         idx = self.resource_names.index("RESOURCE_ID")
         entry = self.index_table["rows"][idx]
         pos = self.header["file_base_offset"] + entry["offset"]
-        ids = []
-        for i in range(self.header["entry_count"]):
-            res_type = buf[pos:pos+16].decode("ascii").strip("\x00")
-            ids.append(res_type)
-            pos += 16
-
-        return ids
+        table = buf[pos:pos + self.header["entry_count"] * 16]
+        return [res_id.strip(b"\x00").decode("ascii") for res_id, in iter_unpack("16s", table)]
 
 
     def __add_resources_to_indx(self):
@@ -140,25 +195,190 @@ class RpsFile:
             self.index_table["rows"][i].update({"filename": filename})
 
 
-    def dump(self):
-        for file in self.index_table["rows"]:
-            with open(self.file, "rb") as f:
-                file_pos = self.header["file_base_offset"] + file["offset"]
-                f.seek(file_pos)
-                data = f.read(file["length"])
-
-                filename = file["filename"]
-                if filename in ["RESOURCE_ID", "RESOURCE_TYPE"]:
-                    continue
-
-                if data[0:4] in EXTENSIONS:  # add .cry to end of file. can't read encrypted files right now.
-                    filename = filename + EXTENSIONS[data[0:4]]
-
-                # write file
-                if d := filename.rsplit("\\", 1)[0]:
-                    os.makedirs(f"{self.output_folder}\\{d}", exist_ok=True)
-                else:
-                    os.makedirs(self.output_folder, exist_ok=True)
-
-                with open(f"{self.output_folder}\\{filename}", "bw+") as f2:
-                    f2.write(data)
+    @property
+    def members(self) -> dict:
+        """
+        Every file in the RPS: filename (as in index_table, ex: "file001.etp") -> memoryview
+        of its data. Nothing is copied; the views point into the RPS's own buffer.
+        """
+        if self._members is None:
+            base = self.header["file_base_offset"]
+            self._members = {
+                row["filename"]: self.file_data[base + row["offset"]:base + row["offset"] + row["length"]]
+                for row in self.index_table["rows"]
+                if row["filename"] not in META_RESOURCES
+            }
+        return self._members
+
+    def open(self, name: str) -> io.BytesIO:
+        """Returns a seekable file object for a member."""
+        return io.BytesIO(self.members[name])
+
+    def output_name(self, name: str) -> str:
+        """
+        Returns the filename extract() writes a member as. Encrypted (CRY) files get .cry
+        added, since we can't read them right now. Everything else keeps the name it has
+        in the RPS, which pack_rps and decrypt_cry_files rely on to find the files again.
+        """
+        if get_extension(self.members[name]) == ".cry":
+            return name + ".cry"
+        return name
+
+    def extract(self, names: list = None, dest: str = None) -> list:
+        """
+        Writes members to dest, straight from the RPS's buffer.
+
+        :param names: Members to write. Defaults to all of them.
+        :param dest: Folder to write to. Defaults to output_folder. Required when the
+            RPS was read from a buffer without a name.
+        :returns: The paths that were written.
+        """
+        dest = dest or self.output_folder
+        if not dest:
+            raise ValueError("RPS was read from a buffer without a name, so a dest folder is required.")
+        written = []
+        for name in (self.members if names is None else names):
+            # member names use \ between folders
+            path = os.path.join(dest, *self.output_name(name).split("\\"))
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(self.members[name])
+            written.append(path)
+        return written
+
+    def dump(self, dest: str = None):
+        """
+        Writes every member to output_folder.
+
+        :param dest: Folder to write to instead. Required when the RPS was read from a
+            buffer without a name.
+        """
+        return self.extract(dest=dest)
+
+
+class RpsWriter:
+    """
+    Builds a new RPS from a parsed RpsFile, swapping in new data for some of its members
+    (ex: translated ETPs). Works with any RPS, not just packageManagerRegistIncludeAutoClient.
+
+    The whole layout is worked out when the writer is created: every resource keeps its
+    place in the file, replaced ones are padded with 0x99 up to the alignment, and
+    everything after them (other files, the RESOURCE_TYPE/RESOURCE_ID tables, the path
+    table and anything between them) moves down by however much the file grew or shrank.
+    write() then writes the file front to back in one pass, with no seeking back to patch.
+    """
+    def __init__(self, rps: RpsFile, replacements: dict = None):
+        """
+        :param rps: The RPS to rebuild.
+        :param replacements: Member name (as in RpsFile.members, ex: "file001.etp") -> new data.
+        """
+        self.rps = rps
+        self.replacements = dict(replacements or {})
+        unknown = self.replacements.keys() - rps.members.keys()
+        if unknown:
+            raise KeyError(f"Not in the RPS: {', '.join(sorted(unknown))}")
+        self.alignment = get_alignment(rps.header["format_ver"])
+        self._layout()
+
+    def _layout(self):
+        rps = self.rps
+        buf = rps.file_data
+        base = rps.header["file_base_offset"]
+        rows = rps.index_table["rows"]
+
+        # one piece per distinct span of the data section. rows that point at the same
+        # span share a piece, unless one of them is being replaced.
+        pieces = []
+        spans = {}
+        self.row_pieces = []
+        for row in rows:
+            start, end = row["offset"], row["offset"] + row["length"]
+            if row["filename"] in self.replacements:
+                piece = {"start": start, "end": end, "data": self.replacements[row["filename"]], "pad": True}
+                pieces.append(piece)
+            else:
+                piece = spans.get((start, end))
+                if piece is None:
+                    piece = {"start": start, "end": end, "data": buf[base+start:base+end], "pad": False}
+                    spans[(start, end)] = piece
+                    pieces.append(piece)
+            self.row_pieces.append(piece)
+        pieces.sort(key=lambda piece: (piece["start"], piece["end"]))
+
+        # walk the data section in file order. bytes that aren't part of any resource
+        # (the path table, usually) are copied as they are.
+        self.parts = []
+        old_pos = new_pos = 0
+        self.old_ends, self.new_ends = [], []
+        for piece in pieces:
+            if piece["start"] < old_pos:
+                raise ValueError(f"Resource at {piece['start']} overlaps the one before it.")
+            gap = buf[base+old_pos:base+piece["start"]]
+            self.parts.append(gap)
+            new_pos += len(gap)
+
+            piece["new_offset"] = new_pos
+            length = len(piece["data"])
+            self.parts.append(piece["data"])
+            if piece["pad"]:
+                padding = -(base + new_pos + length) % self.alignment
+                self.parts.append(PADDING_BYTE * padding)
+                length += padding
+            piece["new_length"] = length
+
+            new_pos += length
+            old_pos = piece["end"]
+            self.old_ends.append(old_pos)
+            self.new_ends.append(new_pos)
+
+        tail = buf[base+old_pos:]
+        self.parts.append(tail)
+        self.size = base + new_pos + len(tail)
+        self.path_table_offset = self._new_position(rps.header["path_table_offset"], pieces)
+
+    def _new_position(self, old: int, pieces: list) -> int:
+        """Returns where something at old (relative to file_base_offset) ends up."""
+        for piece in pieces:
+            if piece["start"] <= old < piece["end"]:
+                if piece["pad"]:
+                    raise ValueError(f"{old} is inside of a resource that's being replaced.")
+                return piece["new_offset"] + old - piece["start"]
+        i = bisect_right(self.old_ends, old)
+        if i == 0:
+            return old
+        return old + self.new_ends[i - 1] - self.old_ends[i - 1]
+
+    def header(self) -> bytes:
+        """Returns the new header, index table and whatever is between them and the data section."""
+        buf = self.rps.file_data
+        base = self.rps.header["file_base_offset"]
+        header = bytearray(buf[0:HEADER_SIZE])
+        pack_into("<I", header, 16, self.size)
+        pack_into("<I", header, 36, self.path_table_offset)
+
+        for row, piece in zip(self.rps.index_table["rows"], self.row_pieces):
+            header += pack("<I I I I", row["count"], piece["new_offset"], piece["new_length"], row["flags"])
+        header += buf[len(header):base]
+        return bytes(header)
+
+    def write(self, file) -> int:
+        """
+        Writes the new RPS.
+
+        :param file: Path to write to, or a file object opened for writing.
+        :returns: Size of the new RPS.
+        """
+        if isinstance(file, (str, os.PathLike)):
+            with open(file, "wb") as f:
+                return self.write(f)
+
+        file.write(self.header())
+        for part in self.parts:
+            file.write(part)
+        return self.size
+
+    def to_bytes(self) -> bytes:
+        """Returns the new RPS."""
+        out = io.BytesIO()
+        self.write(out)
+        return out.getvalue()
@@ -4,15 +4,15 @@ import json
 import os
 import sqlite3
 import sys
-from struct import iter_unpack, pack, unpack
+from struct import pack, unpack
 
 sys.path.append("../../")  # hack to use tools
 from tools.dump_etps.dqxcrypt.dqxcrypt import attach_client, encrypt
+from tools.lib.etpfile import EtpFile
 from tools.lib.fileops import (
     pack_uint,
     pack_ushort,
     unpack_uint,
-    unpack_ushort,
     write_foot,
     write_text,
     write_toof,
@@ -33,18 +33,6 @@ def align_file(file_obj: object, alignment: int):
         file_obj.write(b"\x00" * pad)
 
 
-def determine_etp_version(file: str):
-    with open(file, "rb") as f:
-        magic = unpack("4s", f.read(4))[0]
-        if magic == b"XTVE":
-            return "be"
-        elif magic != b"EVTX":
-            return None
-        f.read(11)
-        version = f.read(1)
-    return int(version.hex())
-
-
 def _pick_translation(record: dict) -> bytes:
     """Returns the translated string (en) if available, otherwise the source (ja), as null-terminated UTF-8 bytes."""
     ja, en = next(iter(record.items()))
@@ -166,25 +154,19 @@ def _recalculate_headers_be(file_obj: object):
     write_toof(file_obj=file_obj)
 
 
-def _build_etp_event_text(json_list: list, src_etp: str):
+def _build_etp_event_text(json_list: list, etp: EtpFile):
     "Builds an ETP file for file versions 0 and 2."
-    # grab original file header data we'll copy over to new file
-    with open(src_etp, "rb") as f:
-        orig_etp_data = f.read(96)
-        indx_size = unpack_uint(orig_etp_data[88:92])
-        orig_indx_table = f.read(indx_size)
-        f.read(32)  # skip past FOOT + TEXT
-        text_start = f.tell()
-
-    etp_file = os.path.basename(src_etp)
+    text_start = etp.text_start
+
+    etp_file = os.path.basename(etp.file)
     with open(f"new_etp/{etp_file}", "w+b") as etp_f:
-        etp_f.write(orig_etp_data)
-        etp_f.write(orig_indx_table)
+        etp_f.write(etp.header)
+        etp_f.write(etp.indx)
         write_foot(file_obj=etp_f)
         write_text(file_obj=etp_f)
         curr_indx_pos = 0
         # iterate over indx entries in table
-        for string_id, offset in iter_unpack("<I I", orig_indx_table):
+        for string_id in etp.string_ids:
             if string_id == 0:
                 continue
             # update the indx entry first. we figure out where this is by jumping to the end
@@ -199,39 +181,19 @@ def _build_etp_event_text(json_list: list, src_etp: str):
         recalculate_headers(file_obj=etp_f)
 
 
-def _build_etp_sub_package(json_list: list, src_etp: str):
+def _build_etp_sub_package(json_list: list, etp: EtpFile):
     "Builds an ETP file for file version 1 (LE) or BE."
-    with open(src_etp, "rb") as f:
-        is_be = f.read(4) == b"XTVE"
-
-    if is_be:
+    if etp.version == "be":
         # BE file layout: (string_id: uint32_BE, byte_offset: uint32_BE) pairs in INDX.
         # Text body is UTF-8 null-terminated strings; offsets are direct byte offsets.
-        with open(src_etp, "rb") as f:
-            orig_etp_data = f.read(96)
-            indx_size = unpack(">I", orig_etp_data[88:92])[0]
-            orig_indx = f.read(indx_size)
-            f.read(32)  # skip TOOF + TXET header
-            text_pos = f.tell()
-            # pre-read all original strings for fallback when a string_id is absent from json_list
-            orig_strings = {}
-            for sid, off in iter_unpack(">II", orig_indx):
-                if sid == 0:
-                    continue
-                f.seek(text_pos + off)
-                buf = bytearray()
-                while True:
-                    ch = f.read(1)
-                    if ch == b"\x00":
-                        break
-                    buf.extend(ch)
-                orig_strings[sid] = buf.decode("utf-8")
+        # original strings are the fallback when a string_id is absent from json_list
+        orig_strings = {sid: etp.text[off] for sid, off in zip(etp.string_ids, etp.offsets) if sid != 0}
 
         str_bytes = bytearray()
         orig_offset_to_new = {}  # deduplication: orig_byte_offset -> new_byte_offset
         new_indx = bytearray()
 
-        for string_id, orig_offset in iter_unpack(">II", orig_indx):
+        for string_id, orig_offset in zip(etp.string_ids, etp.offsets):
             if string_id == 0:
                 new_indx += pack(">II", 0, 0)
                 continue
@@ -251,9 +213,9 @@ def _build_etp_sub_package(json_list: list, src_etp: str):
                     str_bytes += original.encode("utf-8") + b"\x00"
             new_indx += pack(">II", string_id, new_offset)
 
-        etp_file = os.path.basename(src_etp)
+        etp_file = os.path.basename(etp.file)
         with open(f"new_etp/{etp_file}", "w+b") as etp_f:
-            etp_f.write(orig_etp_data)
+            etp_f.write(etp.header)
             etp_f.write(new_indx)
             write_toof(file_obj=etp_f)
             write_txet(file_obj=etp_f)
@@ -262,30 +224,12 @@ def _build_etp_sub_package(json_list: list, src_etp: str):
             _recalculate_headers_be(file_obj=etp_f)
         return
 
-    with open(src_etp, "rb") as f:
-        orig_etp_data = f.read(96)
-        offset_count = unpack_uint(orig_etp_data[44:48])  # get from cmnh
-        indx_size = unpack_uint(orig_etp_data[88:92])
-        orig_indx_table = f.read(indx_size)
-
-    # Parse all original offsets upfront: short (2-byte) table first, then long (4-byte).
-    # Mirrors the same approach used in _parse_etp_sub_package.
-    short_count = unpack_ushort(orig_indx_table[2:4])
-    short_table_end = 20 + short_count * 2
-    short_offsets = [o for o, in iter_unpack("<H", orig_indx_table[20:short_table_end])]
-
-    long_table_start = short_table_end
-    if (long_table_start + 96) % 4 != 0:  # skip CD AB alignment bytes if present
-        long_table_start += 2
-    long_count = offset_count - short_count
-    long_offsets = [o for o, in iter_unpack("<I", orig_indx_table[long_table_start:long_table_start + long_count * 4])]
-
     str_table, str_bytes = _build_string_table(json_list=json_list, start_offset=1)
 
-    etp_file = os.path.basename(src_etp)
+    etp_file = os.path.basename(etp.file)
     with open(f"new_etp/{etp_file}", "w+b") as etp_f:
-        etp_f.write(orig_etp_data)
-        etp_f.write(orig_indx_table[:20])
+        etp_f.write(etp.header)
+        etp_f.write(etp.indx[:20])
 
         # Iterate all offsets in order (short then long). For each, look up its new value
         # and write as ushort or uint. The first time a new offset overflows ushort range,
@@ -294,7 +238,7 @@ def _build_etp_sub_package(json_list: list, src_etp: str):
         end_of_short_pos = 0
         wrote_cdab = False
 
-        for offset in short_offsets + long_offsets:
+        for offset in etp.offsets:
             if offset == 0:
                 etp_f.write(b"\x00\x00" if not wrote_offset_divider else b"\x00\x00\x00\x00")
                 continue
@@ -345,72 +289,23 @@ def _build_etp_sub_package(json_list: list, src_etp: str):
         recalculate_headers(file_obj=etp_f)
 
 
-def get_duplicate_offsets_4(src_etp: str):
-    with open(src_etp, "rb") as f:
-        f.seek(96)
-        indx_header = f.read(20)
-
-        short_id_count   = unpack("<H", indx_header[0:2])[0]
-        short_off_count  = unpack("<H", indx_header[2:4])[0]
-        long_str_start   = unpack("<I", indx_header[8:12])[0]
-        short_off_start  = unpack("<I", indx_header[12:16])[0]
-        long_off_start   = unpack("<I", indx_header[16:20])[0]
-
-        long_id_count  = (short_off_start - long_str_start) // 4
-        total_id_count = short_id_count + long_id_count
-
-        # read all string IDs and offsets as contiguous slices
-        f.seek(96 + 20)
-        short_ids_raw = f.read(short_id_count * 2)
-        f.seek(96 + long_str_start)
-        long_ids_raw = f.read(long_id_count * 4)
-        f.seek(96 + short_off_start)
-        short_offs_raw = f.read(short_off_count * 2)
-        f.seek(96 + long_off_start)
-        long_offs_raw = f.read((total_id_count - short_off_count) * 4)
-
-        all_str_ids = [s for s, in iter_unpack("<H", short_ids_raw)]
-        all_str_ids += [s for s, in iter_unpack("<I", long_ids_raw)]
-        all_offsets = [o for o, in iter_unpack("<H", short_offs_raw)]
-        all_offsets += [o for o, in iter_unpack("<I", long_offs_raw)]
-
-        # associate offset <-> str_id to find duplicates.
-        # the offsets themselves are irrelevant for packing because our data will have
-        # different offsets, so just group the string ids together to get the duplicates.
-        offset_dict = {}
-        for str_id, offset in zip(all_str_ids, all_offsets):
-            if offset in offset_dict:
-                offset_dict[offset].append(str_id)
-            else:
-                offset_dict[offset] = [str_id]
-
-        return list(offset_dict.values())
-
-
-def _build_etp_smldt_msg_pkg(json_list: list, src_etp: str):
+def _build_etp_smldt_msg_pkg(json_list: list, etp: EtpFile):
     "Builds an ETP file for file version 4."
-    with open(src_etp, "rb") as f:
-        orig_etp_data = f.read(116)
-        f.seek(96)
-        orig_indx_table = f.read(unpack("<I", orig_etp_data[88:92])[0])
-
-    indx_header = orig_indx_table[:20]
-    str_table_size  = unpack("<H", indx_header[0:2])[0] * 2
-    long_str_start  = unpack("<I", indx_header[8:12])[0]
-    short_off_start = unpack("<I", indx_header[12:16])[0]
-
     # 2-byte and 4-byte string ID sections — copied unchanged from original
-    short_string_table = orig_indx_table[20:20+str_table_size]
-    long_string_table  = orig_indx_table[long_str_start:short_off_start]
+    short_string_table = etp.short_id_table
+    long_string_table  = etp.long_id_table
 
-    etp_file = os.path.basename(src_etp)
+    etp_file = os.path.basename(etp.file)
     with open(f"new_etp/{etp_file}", "w+b") as etp_f:
         # write beginning of file (includes the 20-byte INDX sub-header verbatim;
         # bytes 8-15 describe string ID section positions which stay the same since
         # we copy both string tables unchanged)
-        etp_f.write(orig_etp_data)
+        etp_f.write(etp.header)
+        etp_f.write(etp.indx[:20])
 
-        dupe_string_list = get_duplicate_offsets_4(src_etp)
+        # the offsets themselves are irrelevant for packing because our data will have
+        # different offsets, so just group the string ids together to get the duplicates.
+        dupe_string_list = etp.duplicates()
         str_text, str_bytes = _build_string_table(json_list=json_list, dupe_string_list=dupe_string_list)
 
         # write 2-byte string ID table
@@ -427,8 +322,7 @@ def _build_etp_smldt_msg_pkg(json_list: list, src_etp: str):
         off_table_start = etp_f.tell()
 
         # iterate all string IDs in order: 2-byte first, then 4-byte
-        all_string_ids = [s[0] for s in iter_unpack("<H", short_string_table)]
-        all_string_ids += [s[0] for s in iter_unpack("<I", long_string_table)]
+        all_string_ids = etp.string_ids
 
         dupe_lookup = {sid: sublist for sublist in dupe_string_list for sid in sublist}
 
@@ -499,16 +393,14 @@ def build_etp(json_file: list, src_etp: str):
         "be": _build_etp_sub_package,
         4: _build_etp_smldt_msg_pkg,
     }
-    file_version = determine_etp_version(file=src_etp)
-    if file_version is None:
-        print("Not an ETP file.")
-        return
-    builder = builders.get(file_version)
-    if builder is None:
-        print(f"ETP version \"{file_version}\" is not currently supported.")
+    # the source ETP is read and parsed once here; the builders only work from this
+    try:
+        etp = EtpFile(src_etp)
+    except ValueError as e:
+        print(e)
         return
     etp_json = read_json_file(file=json_file)
-    builder(json_list=etp_json, src_etp=src_etp)
+    builders[etp.version](json_list=etp_json, etp=etp)
 
 
 def build_all():
@@ -4,7 +4,7 @@ import sqlite3
 import sys
 import zlib
 sys.path.append("../../")  # hack to use tools
-from tools.idx_searcher.main import find_file
+from tools.idx_searcher.main import get_catalog
 from tools.globals import GAME_DATA_DIR
 from tools.lib.fileops import (
     pack_uint,
@@ -246,6 +246,32 @@ def write_etps():
     rps_files = glob.glob("new_rps/*.rps")
     files_to_pack = etp_files + rps_files
 
+    # look up where every file lives before writing anything. writing updates the idx,
+    # which would make the catalog re-read it on every lookup if we interleaved the two.
+    # the idx_offset of a record doesn't change when we point it at a new dat offset.
+    to_write = []
+    with get_catalog() as catalog:
+        for file in files_to_pack:
+            basename = os.path.basename(file)
+            db_result = get_record(etp_file=basename)
+            if not db_result:
+                print(f"Did not find {basename} in the database. Skipping.")
+                continue
+            file_dir_hash = db_result[0]
+
+            try:
+                idx_loc = catalog.find_name(file_dir_hash)
+            except Exception as e:
+                print(
+                    f"Could not find hash in any idx files for file {file}. Skipping. Error: {e}"
+                )
+                continue
+            if not idx_loc:
+                print(f"Could not find hash in any idx files for file {file}. Skipping.")
+                continue
+
+            to_write.append((file, idx_loc))
+
     create_new_dat(
         idx_file=f"{GAME_DATA_DIR}/data00000000.win32.idx",
         dat_num="1"
@@ -253,22 +279,7 @@ def write_etps():
 
     update_idx_dat_count(num_dats=2)
 
-    for file in files_to_pack:
-        basename = os.path.basename(file)
-        db_result = get_record(etp_file=basename)
-        if not db_result:
-            print(f"Did not find {basename} in the database. Skipping.")
-            continue
-        file_dir_hash = db_result[0]
-
-        try:
-            idx_loc = find_file(filename=file_dir_hash)
-        except Exception as e:
-            print(
-                f"Could not find hash in any idx files for file {file}. Skipping. Error: {e}"
-            )
-            continue
-
+    for file, idx_loc in to_write:
         write_to_dat(
             idx_file=idx_loc["idx"],
             idx_offset=idx_loc["idx_offset"],